@@ -39,15 +39,13 @@ class AnalysisParameters(object):
         parametres = {}
         for json_file in setting_json_list:
 
-            module_names = miscellaneous.read_json_file(json_file).keys()
-            for module_name in module_names:
+            settings = miscellaneous.read_json_file(json_file)
+            for module_name, profiles in settings.items():
                 module_name = str(module_name).lower()
                 parametres[module_name] = {}
 
-                for profile in miscellaneous.read_json_file(json_file)[str(module_name)].keys():
-                    profile = str(profile).lower()
-
-                    parametres[module_name][profile] = miscellaneous.read_json_file(json_file)[str(module_name)]
+                for profile, profile_parameters in profiles.items():
+                    parametres[module_name][str(profile).lower()] = profile_parameters
 
         return parametres
 
@@ -82,3 +80,19 @@ class AnalysisParameters(object):
         else:
             logging.error('Analysis parameters profile not found. '
                           'Module:' + str(module_name) + '. Profile:' + str(profile))
+
+
+def get_parameter(parameters, key, default=None):
+    """ Read one analysis parameter of the profile (namespace or dictionary). Default if not defined.
+    :param parameters: analysis parameters (args.parameters)
+    :param key: parameter name
+    :param default: value returned if the parameter is not defined in the profile
+    """
+
+    if parameters is None:
+        return default
+
+    if not isinstance(parameters, dict):
+        parameters = vars(parameters)
+
+    return parameters.get(key, default)
@@ -74,6 +74,14 @@ class Config(object):
     def __getstate__(self):
         return self.__dict__.items()
 
+    def get(self, key, default=None):
+        """ Get variable or the default value if it is not defined (without logging errors)"""
+
+        if key in self.container.keys() and self.container[key] is not None:
+            return self.container[key]
+
+        return default
+
     def asdict(self):
 
         return self.container
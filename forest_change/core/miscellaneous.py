@@ -40,6 +40,12 @@ def is_float(input):
     return True
 
 
+def str2bool(value):
+    """ Convert text values (e.g. 'True', 'yes', '1') to boolean """
+
+    return str(value).strip().lower() in ('yes', 'true', 't', 'y', '1')
+
+
 def cmd(*args):
     """Run cmd and catch the output (always verbose) """
 
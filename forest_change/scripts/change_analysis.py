@@ -9,22 +9,25 @@
 # ==========================================================================================
 """ This module is a test"""
 
+from core import miscellaneous
+from core.analysis_parameters import get_parameter
+from spatial import gdal_import
 from toolbox.image_tools import RasterTools as PyTools
 
 
-# from toolbox.image_tools import RasterTools as PyTools
-# from spatial.saga_cmd import Saga
-
-
 def main(d1, d2, parameters):
 
     # settings:
     equalization = None
     normalisation = None
-    histogram_matching = None
-    method = 'ndvi'       # Intensity, nir or ndvi
+    histogram_matching = miscellaneous.str2bool(get_parameter(parameters, 'histogram_matching', False))
+    method = get_parameter(parameters, 'method', 'ndvi')       # Intensity, nir or ndvi
     obia = False
 
+    # Without pre-processing, the change index of both dates is computed in one pass (see RasterTools.change_index)
+    if not equalization and not normalisation and not histogram_matching:
+        return PyTools().change_index(gdal_import.lazy_import(d1), gdal_import.lazy_import(d2), method=method)
+
     # Pre-processing for both datasets
     data_dict = {}
     j = 0
@@ -33,6 +36,9 @@ def main(d1, d2, parameters):
         # Data storage dict
         j += 1
         data_dict["d" + str(j)] = {}
+
+        # Metadata cached and arrays read only once
+        dataset = gdal_import.lazy_import(dataset)
         data_dict["d" + str(j)]["dataset"] = dataset
 
         if method.lower() == 'nir':
@@ -65,11 +71,11 @@ def main(d1, d2, parameters):
 
         del dataset
 
-        # Histogram matching
-        if histogram_matching:
-            data_dict["d1"]["base_layer"] = PyTools().histogram_matching(input_raster=data_dict["d1"]["base_layer"],
-                                                                         reference=data_dict["d2"]["base_layer"],
-                                                                         output='hist_matching_dataset1')
+    # Histogram matching (the first date is matched to the second date)
+    if histogram_matching:
+        data_dict["d1"]["base_layer"] = PyTools().histogram_matching(input_raster=data_dict["d1"]["base_layer"],
+                                                                     reference=data_dict["d2"]["base_layer"],
+                                                                     output='hist_matching_dataset1')
 
     return PyTools().single_band_calculator(rlist=[data_dict["d1"]["base_layer"], data_dict["d2"]["base_layer"]],
                                             expression='a-b')
\ No newline at end of file
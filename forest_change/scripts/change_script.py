@@ -10,25 +10,188 @@
 
 
 import logging
+import multiprocessing
 import os
 
 from scripts import change_analysis
 from spatial import gdal_import, ogr_import
+from spatial.gdal_reader import GdalReader
+from spatial.raster_cache import ARRAY_CACHE
 from toolbox import raster_tools, image_tools
 
+from core.analysis_parameters import get_parameter
+from core.bunch import Config
 from spatial import raster_tiles
 
+# Forest boundaries of the worker process (see _init_tile_worker)
+WORKER_BOUNDS = {}
+
+
+def tile_change(tile, tile1_ds, tile2_ds, bounds, parameters):
+    """ Change detection of a tile clipped to the boundaries. None if the tile is out of the boundaries.
+    Tiles read with halo are cropped to their core region after the change detection."""
+
+    tile_name = tile.name if tile else '0'
+
+    if bounds:
+        tile1_ds = raster_tools.poly_clip(raster=tile1_ds, polygons=bounds, output=str(tile_name) + "_clipped")
+        tile2_ds = raster_tools.poly_clip(raster=tile2_ds, polygons=bounds, output=str(tile_name) + "_clipped")
+
+        if not tile1_ds or not tile2_ds:
+            logging.debug('Tile out of boundaries: ' + str(tile_name))
+            return
+
+    change_ds = change_analysis.main(d1=tile1_ds, d2=tile2_ds, parameters=parameters)
+
+    if change_ds and tile:
+        change_ds = raster_tiles.crop_tile(change_ds, tile)
+
+    return change_ds
+
+
+def _init_tile_worker(boundary_path):
+    """ Initialise a worker process. Gdal handles inherited from the parent process are not reused."""
+
+    GdalReader.clear_registry()
+    ARRAY_CACHE.clear()
+
+    WORKER_BOUNDS.clear()
+    if boundary_path and os.path.exists(boundary_path):
+        WORKER_BOUNDS['bounds'] = ogr_import.ogr_import(boundary_path)
+
+
+def _change_tile(tile_job):
+    """ Change detection of a tile in a worker process. Only file paths and the tile window are shipped.
+    It returns the tile name and the result: (array, geotransform, projection, nodata) or the path of a
+    scratch file if Config()['tile_results'] is 'file'."""
+
+    dataset1_path, dataset2_path, tile, parameters = tile_job
+
+    tile1_ds = raster_tiles.read_tile(dataset1_path, tile)
+    tile2_ds = raster_tiles.read_tile(dataset2_path, tile)
+
+    change_ds = tile_change(tile, tile1_ds, tile2_ds, WORKER_BOUNDS.get('bounds'), parameters)
+    if not change_ds:
+        return tile.name, None
+
+    change_ds = gdal_import.src2ds(change_ds)
+
+    if str(Config().get('tile_results', 'array')).lower() == 'file':
+        return tile.name, gdal_import.src2file(change_ds, name='change_' + str(tile.name))
+
+    return tile.name, (GdalReader().ds2array(change_ds), change_ds.GetGeoTransform(), change_ds.GetProjection(),
+                       change_ds.GetRasterBand(1).GetNoDataValue())
+
+
+def parallel_tiles_change(dataset1, dataset2, tile_size, boundary_path, parameters, workers, halo=0):
+    """ Run the change detection of each tile in a pool of processes. It yields (tile name, change dataset)
+    as the tiles are completed. The datasets must be files (e.g. VRT), see gdal_import.src_path."""
+
+    # Workers read their own windows from the files
+    dataset1_path = gdal_import.src_path(dataset1)
+    dataset2_path = gdal_import.src_path(dataset2)
+
+    if not dataset1_path or not dataset2_path:
+        raise Exception('Tiles cannot be processed in parallel. The datasets are not files.')
+
+    tile_jobs = ((dataset1_path, dataset2_path, tile, parameters)
+                 for tile in raster_tiles.tile_windows(dataset1_path, tile_size=tile_size, halo=halo))
+
+    pool = multiprocessing.Pool(workers, initializer=_init_tile_worker, initargs=(boundary_path,))
+
+    try:
+        for tile_name, result in pool.imap_unordered(_change_tile, tile_jobs):
+
+            if result is None:
+                continue
+
+            elif isinstance(result, basestring):
+                yield tile_name, gdal_import.src2ds(result)
+
+            else:
+                array, geotransform, projection, nodata = result
+                yield tile_name, GdalReader().array2ds(array, 'change_' + str(tile_name), geotransform=geotransform,
+                                                       projection=projection, nodata=nodata, copy=False)
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def threshold_change(change_raster, output, threshold, parameters, change_histogram=None):
+    """ Classify the change index in positive (10) and negative (20) change. The thresholds are relative to the
+    mode of the change index. A change index exported by main (change_index=True) can be thresholded again
+    without reading it twice: its statistics are read from the sidecar (see raster_tools.save_raster_stats).
+    :param change_histogram: statistics of the change index (see raster_tools.raster_histogram)
+    """
+
+    change_raster = gdal_import.lazy_import(change_raster)
+
+    if change_histogram is None:
+        change_histogram = raster_tools.raster_histogram(change_raster)
+
+    if change_histogram is None:
+        raise Exception('Error in change detection. Change index without valid values.')
+
+    raster_stats = change_histogram.stats()
+
+    # Get normalised values
+    threshold_maximum = raster_stats['mode'] + (abs((raster_stats['max']-raster_stats['mode'])) * float(threshold)/100)
+    threshold_minimum = raster_stats['mode'] - (abs((raster_stats['min']-raster_stats['mode'])) * float(threshold)/100)
+
+    logging.debug('threshold_maximum: ' + str(threshold_maximum))
+    logging.debug('threshold_minimum: ' + str(threshold_minimum))
+
+    # Remove values within the thresholds, positive change (10) and negative change (20)
+    change_classes = [((threshold_minimum, threshold_maximum), None),
+                      ((threshold_maximum, None), 10),
+                      ((None, threshold_minimum), 20)]
+
+    reclassify_raster = raster_tools.reclassify(change_raster, classes=change_classes, output=None)
+
+    # Cloud Optimized GeoTIFF outputs
+    output_profile = get_parameter(parameters, 'output_profile', 'deflate')
+
+    gdal_import.raster2file(reclassify_raster, file_path=output, profile=output_profile)
+
+    # Check output
+    if not os.path.exists(output):
+        raise Exception('Error creating change detection output')
+
+    return output
+
 
 def main(dataset1, dataset2, output, threshold, parameters, boundary_path=None, tile_size=None, change_index=None):
 
-    # Tiling data set
+    # Number of processes for tiles
+    workers = max(1, int(get_parameter(parameters, 'tile_workers', 1)))
+
+    # Overlapping pixels between tiles (the tiles are cropped to their core region after processing)
+    halo = max(0, int(get_parameter(parameters, 'tile_halo', 0)))
+
+    # Tiling data set (tiles are read in streaming order, only when they are processed)
     if tile_size and tile_size > 0:
-        dataset1_tiles = raster_tiles.gdal2tiles(src=dataset1, tile_size=tile_size)
-        dataset2_tiles = raster_tiles.gdal2tiles(src=dataset2, tile_size=tile_size)
+
+        dataset1_ds = gdal_import.src2ds(dataset1)
+        dataset2_ds = gdal_import.src2ds(dataset2)
+
+        if not (dataset1_ds.RasterXSize, dataset1_ds.RasterYSize) == (dataset2_ds.RasterXSize,
+                                                                      dataset2_ds.RasterYSize):
+            logging.error("dataset 1 has not the same size as dataset 2")
+            raise Exception("dataset 1 has not the same size as dataset 2")
+
+        # Both datasets are read with the tile windows of the first one
+        tiles = ((tile, raster_tiles.read_tile(dataset1_ds, tile), raster_tiles.read_tile(dataset2_ds, tile))
+                 for tile in raster_tiles.tile_windows(dataset1_ds, tile_size=tile_size, halo=halo))
+
+        # Workers read the tiles from the files. In-memory datasets are not copied to disk.
+        if workers > 1 and not (gdal_import.src_path(dataset1_ds) and gdal_import.src_path(dataset2_ds)):
+            logging.warning('Datasets are not files. Tiles are processed in a single process.')
+            workers = 1
 
     else:
-        dataset1_tiles = {'0': dataset1}
-        dataset2_tiles = {'0': dataset2}
+        tiles = [(None, dataset1, dataset2)]
+        workers = 1
 
     # if Config()['verbose'] == 'debug':
     #     dataset1_tiles = {}
@@ -37,47 +200,48 @@ def main(dataset1, dataset2, output, threshold, parameters, boundary_path=None,
     #     dataset2_tiles = {}
     #     dataset2_tiles.update(raster_tiles.gdal2tiles(src=dataset2, tile_size=tile_size, tile_id_y=2, tile_id_x=2))
 
-    # Get clip areas
-    if boundary_path and os.path.exists(boundary_path):
-        bounds = ogr_import.ogr_import(boundary_path)
-
-        clipped_dataset1 = {}
-        for tile_name, raster_tile in dataset1_tiles.iteritems():
-            clipped_dataset1[tile_name] = raster_tools.poly_clip(raster=dataset1_tiles[tile_name], polygons=bounds,
-                                                                 output=str(tile_name) + "_clipped")
-        clipped_dataset2 = {}
-        for tile_name, raster_tile in dataset2_tiles.iteritems():
-            clipped_dataset2[tile_name] = raster_tools.poly_clip(raster=dataset2_tiles[tile_name], polygons=bounds,
-                                                                 output=str(tile_name) + "_clipped")
-    else:
-        clipped_dataset1 = dataset1_tiles
-        clipped_dataset2 = dataset2_tiles
+    # Runs change detection script for each tile
+    logging.info('Stating change detection ...')
 
-    # Test number of tiles
-    if len(clipped_dataset1) == len(clipped_dataset2):
-        number_tiles = len(clipped_dataset1)
+    if workers > 1:
+        logging.debug('Processing tiles with ' + str(workers) + ' processes')
+
+        tile_changes = parallel_tiles_change(dataset1, dataset2, tile_size, boundary_path, parameters, workers,
+                                             halo=halo)
 
     else:
-        logging.error("dataset 1 has not the same size as dataset 2")
-        number_tiles = min(len(clipped_dataset1), len(clipped_dataset2))
+        # Get clip areas
+        bounds = None
+        if boundary_path and os.path.exists(boundary_path):
+            bounds = ogr_import.ogr_import(boundary_path)
 
-    # Runs change detection script for each tile
-    logging.info('Stating change detection ...')
+        tile_changes = ((tile.name if tile else '0', tile_change(tile, tile1_ds, tile2_ds, bounds, parameters))
+                        for tile, tile1_ds, tile2_ds in tiles)
 
-    change_rasters = []
-    for tile_id in xrange(number_tiles):
-        change_rasters.append(change_analysis.main(d1=clipped_dataset1.items()[tile_id][1],
-                                                   d2=clipped_dataset2.items()[tile_id][1], parameters=parameters))
+    # Tiles are merged as they are completed (only one tile is kept in memory)
+    change_raster = None
+    mosaic = None
+    if tile_size and tile_size > 0:
+        # Same extent than the change detection without tiles (clipped to the boundaries)
+        polygons = boundary_path if boundary_path and os.path.exists(boundary_path) else None
+        mosaic = raster_tools.mosaic(dataset1, outname='change', polygons=polygons)
 
-    # Merge tiles
-    logging.debug('Merging Tiles:')
-    logging.debug(str(change_rasters))
+    for tile_name, change_ds in tile_changes:
+        if not change_ds:
+            continue
 
-    if len(xrange(number_tiles)) > 1:
-        change_raster = raster_tools.merge(src_list=change_rasters, outname='change', smooth_edges=False)
+        if mosaic:
+            logging.debug('Merging Tile: ' + str(tile_name))
+            mosaic.add(change_ds)
 
-    else:
-        change_raster = change_rasters[0]
+        else:
+            change_raster = change_ds
+
+    if mosaic:
+        change_raster = mosaic.close()
+
+    if not change_raster:
+        raise Exception('Error in change detection. No tiles found.')
 
     # Get Change detection for all tiles merged
     # change_raster = image_tools.RasterTools().normalisation(change_raster)
@@ -86,36 +250,24 @@ def main(dataset1, dataset2, output, threshold, parameters, boundary_path=None,
 
     logging.debug('Reclassifying Raster:')
     logging.debug(str(change_raster))
-    raster_stats = raster_tools.raster_stats(change_raster)
 
-    # Get normalised values
-    threshold_maximum = raster_stats['mode'] + (abs((raster_stats['max']-raster_stats['mode'])) * float(threshold)/100)
-    threshold_minimum = raster_stats['mode'] - (abs((raster_stats['min']-raster_stats['mode'])) * float(threshold)/100)
+    # The change raster is read once for statistics and reclassification
+    change_raster = gdal_import.lazy_import(change_raster)
+    change_histogram = raster_tools.raster_histogram(change_raster)
 
-    logging.debug('threshold_maximum: ' + str(threshold_maximum))
-    logging.debug('threshold_minimum: ' + str(threshold_minimum))
-
-    # Remove lower than threshold (positive)
-    reclassify_raster = raster_tools.reclassify(change_raster, new_value='nan',
-                                                old_value_min=threshold_minimum,
-                                                old_value_max=threshold_maximum, output=None)
-
-    # Remove lower than threshold (negative)
-    reclassify_raster = raster_tools.reclassify(reclassify_raster, new_value=10,
-                                                old_value_min=threshold_maximum, old_value_max=None, output=None)
-
-    reclassify_raster = raster_tools.reclassify(reclassify_raster, new_value=20,
-                                                old_value_min=None, old_value_max=threshold_minimum, output=None)
-
-    gdal_import.raster2file(reclassify_raster, file_path=output)
+    if change_histogram is None:
+        raise Exception('Error in change detection. Change index without valid values.')
 
-    # Check output
-    if not os.path.exists(output):
-        raise Exception('Error creating change detection output')
+    output = threshold_change(change_raster, output, threshold, parameters, change_histogram=change_histogram)
 
     if change_index:
+        output_profile = get_parameter(parameters, 'output_profile', 'deflate')
+
         output2 = os.path.splitext(output)[0] + 'change_index' + os.path.splitext(output)[1]
-        gdal_import.raster2file(change_raster, file_path=output2)
+        gdal_import.raster2file(change_raster, file_path=output2, profile=output_profile)
+
+        # Statistics of the change index are reused if it is thresholded again (see threshold_change)
+        raster_tools.save_raster_stats(output2, change_histogram)
 
         output = [output, output2]
 
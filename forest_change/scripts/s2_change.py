@@ -17,10 +17,15 @@ from scripts import change_script
 from spatial import s2reader
 from toolbox import raster_tools
 
+from core import miscellaneous
+from core.analysis_parameters import get_parameter
 from core.bunch import Config
 
 
-def sentinel2rgbn(s2_product_path, resolution, output='s2_rgbn'):
+def sentinel2rgbn(s2_product_path, resolution, output='s2_rgbn', virtual=False):
+    """ Stack the RGBN bands of the S2 product
+    :param virtual: Boolean. Stack the bands as VRT referencing the JP2 files (no copy of the scene)
+    """
 
     if resolution == 10 or str(resolution).lower() == 'r10m':
         resolution = 'R10m'
@@ -51,7 +56,7 @@ def sentinel2rgbn(s2_product_path, resolution, output='s2_rgbn'):
 
         output = os.path.join(output, '_' + str(s2_product))
 
-        outputs[s2_product] = raster_tools.single_bands_to_multiband(s2_bands, output=output)
+        outputs[s2_product] = raster_tools.single_bands_to_multiband(s2_bands, output=output, virtual=virtual)
 
     return outputs
 
@@ -112,19 +117,27 @@ def main(args):
 
     # Change detection
 
+    # Bands are read from the JP2 files only where required
+    virtual = miscellaneous.str2bool(get_parameter(args.parameters, 'virtual_stack', False))
+
+    # Tiles size (no tiles if 0)
+    tile_size = int(get_parameter(args.parameters, 'tile_size', 0)) or None
+
     # Parameter space 60m Output
     resolution = 60
     output = os.path.join(output_dir, 'change_output.tif')
 
-    s2_bands_newer_rgbn = sentinel2rgbn(s2_bands_newer_product, resolution=resolution, output='s2_rgbn')
-    s2_bands_older_rgbn = sentinel2rgbn(s2_bands_older_product, resolution=resolution, output='s2_rgbn')
+    s2_bands_newer_rgbn = sentinel2rgbn(s2_bands_newer_product, resolution=resolution, output='s2_rgbn',
+                                        virtual=virtual)
+    s2_bands_older_rgbn = sentinel2rgbn(s2_bands_older_product, resolution=resolution, output='s2_rgbn',
+                                        virtual=virtual)
 
     s2_bands_newer_rgbn = s2_bands_newer_rgbn[s2_bands_newer_rgbn.keys()[0]]
     s2_bands_older_rgbn = s2_bands_older_rgbn[s2_bands_older_rgbn.keys()[0]]
 
     output = change_script.main(s2_bands_newer_rgbn, s2_bands_older_rgbn, output=output,
                                 threshold=args.threshold, boundary_path=boundaries,
-                                tile_size=None, parameters=args.parameters)
+                                tile_size=tile_size, parameters=args.parameters)
 
     # Additional 10m output
     if 'additional_outputs' in args and args.additional_outputs:
@@ -135,15 +148,17 @@ def main(args):
         if not os.path.exists(os.path.dirname(output)):
             os.makedirs(os.path.dirname(output))
 
-        s2_bands_newer_rgbn = sentinel2rgbn(s2_bands_newer_product, resolution=resolution, output='s2_rgbn')
-        s2_bands_older_rgbn = sentinel2rgbn(s2_bands_older_product, resolution=resolution, output='s2_rgbn')
+        s2_bands_newer_rgbn = sentinel2rgbn(s2_bands_newer_product, resolution=resolution, output='s2_rgbn',
+                                            virtual=virtual)
+        s2_bands_older_rgbn = sentinel2rgbn(s2_bands_older_product, resolution=resolution, output='s2_rgbn',
+                                            virtual=virtual)
 
         s2_bands_newer_rgbn = s2_bands_newer_rgbn[s2_bands_newer_rgbn.keys()[0]]
         s2_bands_older_rgbn = s2_bands_older_rgbn[s2_bands_older_rgbn.keys()[0]]
 
         change_script.main(s2_bands_newer_rgbn, s2_bands_older_rgbn, output=output,
                            threshold=args.threshold, boundary_path=boundaries,
-                           tile_size=None, parameters=args.parameters, change_index=True)
+                           tile_size=tile_size, parameters=args.parameters, change_index=True)
 
     # Wipe temp files
     if not Config()['verbose'] == 'debug':
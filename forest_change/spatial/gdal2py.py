@@ -8,7 +8,14 @@
 # COPYRIGHT:	(C) 2018 Treemetrics. All rights reserved.
 # ==========================================================================================
 
-from spatial import GdalReader
+import itertools
+import os
+
+from spatial.gdal_reader import GdalReader
+from spatial.raster_cache import ARRAY_CACHE
+
+# Unique keys for in-memory datasets
+_MEM_KEYS = itertools.count()
 
 
 class Gdal2Py(object):
@@ -68,3 +75,61 @@ class Gdal2Py(object):
                 # else:
                 self.array = GdalReader().ds2array(ds, sparse=False)
                 # ds.GetMetadata('IMAGE_STRUCTURE')
+
+
+class LazyGdal2Py(Gdal2Py):
+    """ Gdal2Py with the metadata cached once and the arrays loaded on first access. Loaded arrays are kept in
+    the process-wide array cache (LRU), so repeated readings of the same dataset do not access GDAL again."""
+
+    __slots__ = ('geotransform', 'cache_key')
+
+    def __init__(self, ds):
+        """ Read gdal data source metadata (instance variable) """
+
+        Gdal2Py.__init__(self, ds, data=False)
+
+        self.geotransform = ds.GetGeoTransform()
+
+        # Files are shared by fingerprint. In-memory datasets only by this handle.
+        file_path = ds.GetDescription()
+        if file_path and os.path.isfile(file_path):
+            self.cache_key = GdalReader().fingerprint(file_path)
+
+        else:
+            self.cache_key = ('MEM', next(_MEM_KEYS))
+
+    def __del__(self):
+
+        if self.cache_key[0] == 'MEM':
+            ARRAY_CACHE.discard(self.cache_key)
+
+    @property
+    def array(self):
+        """ Raster array (same layout than GdalReader.ds2array)"""
+
+        return self.read()
+
+    def read(self, bands=None):
+        """ Read the bands (starting from 1). Single bands and band stacks are cached, so the data is decoded
+        (and stacked) only once. 2D array for single band and 3D for multiple bands."""
+
+        if bands is None:
+            bands = range(1, self.bands + 1)
+
+        if len(bands) == 1:
+            key = (self.cache_key, bands[0])
+
+        else:
+            key = (self.cache_key, tuple(bands))
+
+        array = ARRAY_CACHE.get(key)
+        if array is None:
+            array = ARRAY_CACHE.put(key, GdalReader().ds2array(self.ds, bands=list(bands)))
+
+        return array
+
+    def GetGeoTransform(self):
+        return self.geotransform
+
+    def GetProjection(self):
+        return self.projection
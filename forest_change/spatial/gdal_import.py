@@ -12,13 +12,28 @@
 import logging
 import os
 
+from core import miscellaneous
+from core.bunch import Config
+from spatial.gdal2py import Gdal2Py, LazyGdal2Py
 from spatial.gdal_reader import GdalReader
 
 
-def raster2file(raster, file_path):
+def raster2file(raster, file_path, profile=None):
+    """ Save raster as GeoTiff.
+    :param profile: Cloud Optimized GeoTIFF compression profile (see GdalReader.output_profiles).
+    Plain GeoTIFF if not defined.
+    """
 
     ds = src2ds(raster)
-    GdalReader().gdal2file(ds, file_path, driver_name='GTiff')
+
+    if profile:
+        out_ds = GdalReader().gdal2cog(ds, file_path, profile=profile)
+
+    else:
+        out_ds = GdalReader().gdal2file(ds, file_path, driver_name='GTiff')
+
+    # Close file
+    out_ds = None
 
     if os.path.exists(file_path):
         return file_path
@@ -32,10 +47,11 @@ def gdal_import(gdal_src, load_data=True):
 
     logging.debug("Importing file  " + str(gdal_src))
 
-    if src2ds(gdal_src):
+    src_ds = src2ds(gdal_src)
+    if src_ds:
 
         # Work directly in org
-        return src2ds(gdal_src)
+        return src_ds
 
         # Work in with py-dict
         # return Gdal2Py(ds=src)
@@ -47,19 +63,76 @@ def gdal_import(gdal_src, load_data=True):
 def src2ds(src):
     logging.debug("Importing file tiles " + str(src))
 
-    if GdalReader().isvalid(src):
-        return src
+    # Python rasters
+    if isinstance(src, Gdal2Py):
+        return GdalReader().gdal2ds(src.ds)
+
+    # Validated once (see GdalReader.gdal2ds registry)
+    src_ds = GdalReader().gdal2ds(src)
+    if src_ds:
+        return src_ds
 
     else:
         try:
-            GdalReader().isvalid(src.ds)
-            return src.ds
+            return GdalReader().gdal2ds(src.ds)
 
         except:
 
             logging.exception(" Unknown source.")
 
 
+def src_path(src):
+    """ File path of a gdal source, so it can be opened by other processes. None for in-memory datasets."""
+
+    src_ds = src2ds(src)
+    src_ds.FlushCache()
+
+    file_path = src_ds.GetDescription()
+    if file_path and os.path.isfile(file_path):
+        return file_path
+
+
+def src2file(src, name='scratch'):
+    """ File path of a gdal source, so it can be opened by other processes.
+    In-memory datasets are saved as GeoTiff in the tempdir."""
+
+    file_path = src_path(src)
+    if file_path:
+        return file_path
+
+    src_ds = src2ds(src)
+    file_path = miscellaneous.new_unique_file(os.path.join(Config()['tempdir'], str(name) + '.tif'))
+    out_ds = GdalReader().gdal2file(src_ds, file_path, driver_name='GTiff')
+
+    # Close file
+    out_ds = None
+
+    return file_path
+
+
+def src2array(src, bands=None):
+    """ Read the array of a gdal source. Lazy rasters are read only once (see LazyGdal2Py)
+    :param src: gdal source
+    :param bands: list of band numbers (starting from 1) to be read. All bands if not defined.
+    """
+
+    if isinstance(src, LazyGdal2Py):
+        return src.read(bands=bands)
+
+    return GdalReader().ds2array(src2ds(src), bands=bands)
+
+
+def lazy_import(src):
+    """ Load a gdal source as lazy raster (metadata cached and arrays loaded on first access)"""
+
+    if isinstance(src, LazyGdal2Py):
+        return src
+
+    src_ds = src2ds(src)
+    if src_ds:
+        return LazyGdal2Py(src_ds)
+
+
 def py2gdal(py_raster):
     """ Convert python format to gdal"""
 
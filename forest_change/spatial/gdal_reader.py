@@ -8,9 +8,13 @@
 # COPYRIGHT:	(C) 2018 Treemetrics. All rights reserved.
 # ==========================================================================================
 
+import contextlib
 import logging
+import math
 import numpy as np
 import os
+import threading
+import weakref
 from collections import namedtuple
 
 import osr
@@ -19,6 +23,7 @@ from core import miscellaneous
 from gdalconst import *
 
 from core.bunch import Config
+from toolbox import numpy_tools
 
 try:
     import gdal  # from gdal import *
@@ -32,10 +37,41 @@ except ImportError:
 # Register all drivers
 gdal.AllRegister()
 
+# Registry of validated datasets (see GdalReader.gdal2ds). Only the validation of files is kept (by path and
+# fingerprint, no handles) and in-memory handles are weak references, so the registry does not keep datasets alive.
+VALIDATED_FILES = {}
+VALIDATED_DS = weakref.WeakValueDictionary()
+
+# Numpy buffers wrapped as MEM datasets (see GdalReader.array2mem). The buffer lives as long as the dataset.
+MEM_BUFFERS = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def config_option(key, value, thread_local=False):
+    """ Set a GDAL configuration option inside the block and restore the previous value on exit.
+    :param thread_local: Boolean. Set the option only for the current thread (if supported by GDAL)
+    """
+
+    if thread_local and hasattr(gdal, 'SetThreadLocalConfigOption'):
+        get_option, set_option = gdal.GetThreadLocalConfigOption, gdal.SetThreadLocalConfigOption
+
+    else:
+        get_option, set_option = gdal.GetConfigOption, gdal.SetConfigOption
+
+    previous = get_option(key)
+    set_option(key, value)
+
+    try:
+        yield
+
+    finally:
+        set_option(key, previous)
+
 
 class GdalReader:
 
     extent_tuple = namedtuple('extent', ['xmin', 'xmax', 'ymin', 'ymax'])
+    window_tuple = namedtuple('window', ['xoff', 'yoff', 'xsize', 'ysize'])
 
     np2gdal = {
         "uint8": 1,
@@ -49,6 +85,13 @@ class GdalReader:
         "complex64": 10,
         "complex128": 11}
 
+    # Compression of the output profiles (see gdal2cog)
+    output_profiles = {
+        'none': 'NONE',
+        'lzw': 'LZW',
+        'deflate': 'DEFLATE',
+        'zstd': 'ZSTD'}
+
     def __init__(self):
         """ Read gdal data source (instance variable) """
 
@@ -113,13 +156,73 @@ class GdalReader:
 
         return pixel, line
 
-    def ds2array(self, src_ds, sparse=False):
-        """Convert ds to python array"""
+    def read_array(self, src_ds, bands=None, window=None):
+        """ Read only the requested bands in the window. 2D array for single band and 3D for multiple bands.
+        :param src_ds: source gdal dataset
+        :param bands: list of band numbers (starting from 1). All bands if not defined.
+        :param window: window_tuple. Full dataset if not defined.
+        """
+
+        if window is None:
+            window = self.window_tuple(xoff=0, yoff=0, xsize=src_ds.RasterXSize, ysize=src_ds.RasterYSize)
+
+        # Datasets wrapping a numpy buffer return the original buffer (views if possible)
+        buffer_array = self.mem_buffer(src_ds)
+
+        if buffer_array is not None:
+            arr = buffer_array[:, window.yoff:window.yoff + window.ysize, window.xoff:window.xoff + window.xsize]
+
+            if bands is not None:
+                arr = arr[[band - 1 for band in bands]] if len(bands) > 1 else arr[bands[0] - 1:bands[0]]
+
+            return arr[0] if len(arr) == 1 else arr
+
+        if bands is None:
+            # The array is already returned in the band data type (no extra copy required)
+            return gdal_array.DatasetReadAsArray(src_ds, window.xoff, window.yoff, window.xsize, window.ysize)
+
+        # Decode only the requested bands
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(src_ds.GetRasterBand(bands[0]).DataType)
+        arr = np.empty((len(bands), window.ysize, window.xsize), dtype=dtype)
 
-        # Dected array type, Numpy nan is only compatible with float64
-        dtype = [key for key, value in self.np2gdal.iteritems() if value == src_ds.GetRasterBand(1).DataType][0]
-        numpy_array = getattr(np, dtype)
-        arr = numpy_array(gdal_array.DatasetReadAsArray(src_ds))
+        for i, band in enumerate(bands):
+            src_ds.GetRasterBand(band).ReadAsArray(window.xoff, window.yoff, window.xsize, window.ysize,
+                                                   buf_obj=arr[i])
+
+        return arr[0] if len(bands) == 1 else arr
+
+    def window_reader(self, src_ds, bands=None):
+        """ Function reading a window of the dataset (see read_array) and a boolean, True if the function can be
+        called from several threads. File datasets are opened once per thread and buffers wrapped by MEM datasets
+        are sliced, otherwise the dataset handle is shared and windows must be read sequentially.
+        """
+
+        if self.mem_buffer(src_ds) is not None:
+            return lambda window: self.read_array(src_ds, bands=bands, window=window), True
+
+        file_path = src_ds.GetDescription()
+        if file_path and os.path.isfile(file_path):
+            local = threading.local()
+
+            def read_window(window):
+                if getattr(local, 'ds', None) is None:
+                    local.ds = gdal.Open(file_path)
+
+                return self.read_array(local.ds, bands=bands, window=window)
+
+            return read_window, True
+
+        return lambda window: self.read_array(src_ds, bands=bands, window=window), False
+
+    def ds2array(self, src_ds, sparse=False, bands=None):
+        """Convert ds to python array
+        :param bands: list of band numbers (starting from 1) to be read. All bands if not defined.
+        """
+
+        arr = self.read_array(src_ds, bands=bands)
+
+        if sparse and self.mem_buffer(src_ds) is not None:
+            arr = arr.copy()
 
         # srcArray = gdalnumeric.LoadFile(raster)
 
@@ -171,26 +274,165 @@ class GdalReader:
             # else:
             #     return arr
 
-    def isvalid(self, ds):
-        if self.gdal2ds(ds):
+    def block_windows(self, src_ds, chunk_shape=None):
+        """ Yield the windows covering the dataset aligned to the native block size of the first band.
+        :param src_ds: source gdal dataset
+        :param chunk_shape: (rows, cols) requested. It is rounded up to a multiple of the block size.
+        """
+
+        xsize = src_ds.RasterXSize
+        ysize = src_ds.RasterYSize
+        block_xsize, block_ysize = src_ds.GetRasterBand(1).GetBlockSize()
+
+        if chunk_shape:
+            chunk_ysize, chunk_xsize = [int(i) for i in chunk_shape]
+            block_xsize = int(math.ceil(float(chunk_xsize) / block_xsize)) * block_xsize
+            block_ysize = int(math.ceil(float(chunk_ysize) / block_ysize)) * block_ysize
+
+        block_xsize = max(1, min(block_xsize, xsize))
+        block_ysize = max(1, min(block_ysize, ysize))
+
+        for yoff in xrange(0, ysize, block_ysize):
+            for xoff in xrange(0, xsize, block_xsize):
+                yield self.window_tuple(xoff=xoff, yoff=yoff, xsize=min(block_xsize, xsize - xoff),
+                                        ysize=min(block_ysize, ysize - yoff))
+
+    def iter_blocks(self, src_ds, chunk_shape=None, bands=None):
+        """ Read the dataset window by window. It yields (window, array) where the array has the same
+        layout than ds2array (2D for single band, 3D for multiple bands).
+        :param src_ds: source gdal dataset
+        :param chunk_shape: (rows, cols) requested. Native block size if not defined.
+        :param bands: list of band numbers (starting from 1) to be read. All bands if not defined.
+        """
+
+        for window in self.block_windows(src_ds, chunk_shape=chunk_shape):
+            yield window, self.read_array(src_ds, bands=bands, window=window)
+
+    @staticmethod
+    def write_block(out_ds, array, xoff=0, yoff=0):
+        """ Write a 2D (single band) or 3D (multiple bands) array in the dataset window"""
+
+        if array.ndim == 2:
+            array = [array]
+
+        for bid in xrange(len(array)):
+            out_ds.GetRasterBand(bid + 1).WriteArray(array[bid], xoff, yoff)
+
+    def blocks2ds(self, blocks, output, mask_ds, nodata=None):
+        """ Create a new dataset from an iterable of (window, array) with the same size of the mask.
+        Only one block is kept in memory.
+        """
+
+        out_ds = None
+        for window, array in blocks:
+
+            if out_ds is None:
+                nbands = 1 if array.ndim == 2 else len(array)
+                out_ds = self.create_ds(output, mask_ds.RasterXSize, mask_ds.RasterYSize, nbands,
+                                        self.np2type(array))
+                out_ds.SetGeoTransform(mask_ds.GetGeoTransform())
+                out_ds.SetProjection(mask_ds.GetProjection())
+
+                if nodata is None:
+                    nodata = mask_ds.GetRasterBand(1).GetNoDataValue()
+
+                if not miscellaneous.is_number(nodata):
+                    nodata = 0
+
+                for bid in xrange(nbands):
+                    out_ds.GetRasterBand(bid + 1).SetNoDataValue(nodata)
+
+            self.write_block(out_ds, array, window.xoff, window.yoff)
+
+        if out_ds is None:
+            logging.error('Creating new blocks2ds failed. No blocks found.')
+            return
+
+        out_ds.FlushCache()
+        return out_ds
+
+    def isvalid(self, ds, deep=None):
+        if self.gdal2ds(ds, deep=deep):
             return True
 
         else:
             logging.debug("GDAL source is not valid.")
             return False
 
-    def gdal2ds(self, source, check_proj=True):
-        """ Check if the file is a valid gdal _raster"""
+    @staticmethod
+    def clear_registry():
+        """ Forget the validated datasets (e.g. handles inherited by a forked process)"""
+
+        VALIDATED_FILES.clear()
+        VALIDATED_DS.clear()
+
+    @staticmethod
+    def fingerprint(source):
+        """ Cheap fingerprint of a gdal source (metadata only). Files are identified by path, size and
+        modification time and datasets by description, size and number of bands."""
+
+        if isinstance(source, basestring):
+            if not os.path.isfile(source):
+                return
+
+            stat = os.stat(source)
+            return os.path.abspath(source), stat.st_size, stat.st_mtime
+
+        try:
+            return source.GetDescription(), source.RasterXSize, source.RasterYSize, source.RasterCount
+
+        except AttributeError:
+            return
+
+    def _validate(self, ds, deep=False):
+        """ Check that the bands of the dataset can be read. Only metadata is read unless deep is True,
+        in which case every band is decoded to compute its checksum."""
+
+        for i in xrange(ds.RasterCount):
+            band = ds.GetRasterBand(i + 1)
+            if band is None:
+                return False
+
+            if deep:
+                band.Checksum()
+                if gdal.GetLastErrorType() != 0:
+                    return False
+
+        return True
+
+    def gdal2ds(self, source, check_proj=True, deep=None):
+        """ Check if the file is a valid gdal _raster. Valid sources are registered, so each dataset is
+        validated only once.
+        :param source: gdal dataset or file path
+        :param check_proj: Boolean. Reject datasets without projection
+        :param deep: Boolean. Decode all bands (checksum) to validate the data. Config()['deep_validation'] if None.
+        """
 
         if not source:
             logging.error("GDAL source not defined.")
             return False
 
+        if deep is None:
+            deep = bool(Config().get('deep_validation', False))
+
         # SAGA fix
         if os.path.isfile(str(source)):
             if os.path.splitext(source)[0] == '.sgrd':
                 source = os.path.splitext(source)[0] + '.sdat'
 
+        # Find in the registry of validated datasets
+        fingerprint = self.fingerprint(source)
+        if isinstance(source, basestring):
+            key = (fingerprint, check_proj, deep)
+            if fingerprint and VALIDATED_FILES.get(fingerprint[0]) == key:
+                # Validated file. Each caller gets its own handle (gdal handles are not thread-safe).
+                return gdal.Open(source, GA_ReadOnly)
+
+        else:
+            key = (id(source), fingerprint, check_proj, deep)
+            if fingerprint and key in VALIDATED_DS:
+                return VALIDATED_DS[key]
+
         # Check if file
         try:
             gdal.UseExceptions()
@@ -202,10 +444,8 @@ class GdalReader:
 
         # Check data source
         try:
-            for i in xrange(ds.RasterCount):
-                ds.GetRasterBand(i + 1).Checksum()
-                if gdal.GetLastErrorType() != 0:
-                    return False
+            if not self._validate(ds, deep=deep):
+                return False
 
             # Check data projection
             projection = ds.GetProjection()
@@ -220,16 +460,100 @@ class GdalReader:
                 logging.warning("Data source has NOT projection information. " + str(source))
                 return
 
+        # Register dataset (files by path, so the validation of old versions of the file is replaced)
+        if fingerprint and isinstance(source, basestring):
+            VALIDATED_FILES[fingerprint[0]] = key
+
+        elif fingerprint:
+            try:
+                VALIDATED_DS[key] = ds
+
+            except TypeError:
+                # Dataset handle does not support weak references
+                pass
+
         return ds
 
     def gdal2file(self, source, file_path, driver_name='GTiff'):
 
         return gdal.GetDriverByName(driver_name).CreateCopy(file_path, source, 0)
 
-    def create_ds(self, name, x_res, y_res, nbands, data_type):
+    def gdal2cog(self, source, file_path, profile='deflate', block_size=512):
+        """ Save the dataset as Cloud Optimized GeoTIFF (tiled, compressed and with internal overviews).
+        Compression and overviews use Config()['gdal_threads'] threads (all CPUs by default).
+        :param source: gdal dataset
+        :param file_path: output file path
+        :param profile: compression profile (see output_profiles)
+        :param block_size: tile size in pixels
+        """
+
+        if str(profile).lower() not in self.output_profiles:
+            logging.warning('Output profile not found: ' + str(profile) + '. Using deflate.')
+            profile = 'deflate'
+
+        compress = self.output_profiles[str(profile).lower()]
+        threads = str(Config().get('gdal_threads', 'ALL_CPUS'))
+
+        # Floats are averaged in the overviews and predicted as floating point. Classes are not interpolated.
+        data_type = source.GetRasterBand(1).DataType
+        is_float = data_type in (GDT_Float32, GDT_Float64)
+        resampling = 'AVERAGE' if is_float else 'NEAREST'
+
+        if gdal.GetDriverByName('COG'):
+            options = ['COMPRESS=' + compress, 'NUM_THREADS=' + threads, 'BLOCKSIZE=' + str(block_size),
+                       'OVERVIEWS=AUTO', 'RESAMPLING=' + resampling, 'BIGTIFF=IF_SAFER']
+
+            if not compress == 'NONE':
+                options.append('PREDICTOR=YES')
+
+            return gdal.GetDriverByName('COG').CreateCopy(file_path, source, 0, options=options)
+
+        # GDAL < 3.1. Tiled GTiff with the overviews copied from a temporary file
+        options = ['TILED=YES', 'BLOCKXSIZE=' + str(block_size), 'BLOCKYSIZE=' + str(block_size),
+                   'BIGTIFF=IF_SAFER']
+
+        tempdir = Config()['tempdir']
+        if not os.path.exists(tempdir):
+            os.makedirs(tempdir)
+
+        tmp_path = miscellaneous.new_unique_file(
+            os.path.join(tempdir, os.path.splitext(os.path.basename(file_path))[0] + '_overviews.tif'))
+        tmp_ds = gdal.GetDriverByName('GTiff').CreateCopy(tmp_path, source, 0, options=options)
+
+        levels = []
+        level = 2
+        while max(source.RasterXSize, source.RasterYSize) / level >= block_size:
+            levels.append(level)
+            level *= 2
+
+        if levels:
+            with config_option('GDAL_NUM_THREADS', threads):
+                tmp_ds.BuildOverviews(resampling, levels)
+
+        options = options + ['COPY_SRC_OVERVIEWS=YES', 'COMPRESS=' + compress, 'NUM_THREADS=' + threads]
+        if not compress == 'NONE':
+            options.append('PREDICTOR=' + ('3' if is_float else '2'))
+
+        out_ds = gdal.GetDriverByName('GTiff').CreateCopy(file_path, tmp_ds, 0, options=options)
+
+        tmp_ds = None
+        gdal.GetDriverByName('GTiff').Delete(tmp_path)
+
+        return out_ds
+
+    @staticmethod
+    def scratch_driver(name, nbytes=None):
+        """ Get the driver name, the file name and the creation options for a new dataset.
+        Datasets without directory are scratch datasets. They are created in memory (MEM) if the size is
+        lower than Config()['memory_budget'] (MB, 2048 by default). Larger datasets are written in the tempdir
+        as raw ENVI or tiled GTiff files (Config()['scratch_format']).
+        :param name: file path or name of the new dataset
+        :param nbytes: size of the dataset in bytes (unknown if not defined)
+        """
+
         # Get global variables
         tempdir = Config()['tempdir']
-        verbose_level = Config()['verbose']
+        options = []
 
         file_extention = os.path.splitext(name)[1].lower()
         if os.path.exists(os.path.dirname(name)):
@@ -245,19 +569,43 @@ class GdalReader:
         else:
 
             name = os.path.basename(os.path.splitext(name)[0])
+            memory_budget = float(Config().get('memory_budget', 2048)) * 1024 ** 2
+
+            if nbytes is None or nbytes <= memory_budget:
+                driver_name = 'MEM'
+                name = name
 
-            if verbose_level == 'debug':
+            elif str(Config().get('scratch_format', 'ENVI')).lower() == 'gtiff':
                 driver_name = 'GTiff'
                 name = miscellaneous.new_unique_file(os.path.join(tempdir, str(name) + '.tif'))
+                options = ['TILED=YES', 'BIGTIFF=IF_SAFER']
 
             else:
-                driver_name = 'MEM'
-                name = name
+                driver_name = 'ENVI'
+                name = miscellaneous.new_unique_file(os.path.join(tempdir, str(name) + '.dat'))
+                options = ['INTERLEAVE=BSQ']
+
+            logging.debug('Scratch dataset ' + str(name) + ' (' + str(round((nbytes or 0) / 1024.0 ** 2, 1)) +
+                          ' MB) created with ' + driver_name + ' driver. Memory budget: ' +
+                          str(round(memory_budget / 1024 ** 2, 1)) + ' MB')
 
         if not driver_name == 'MEM' and not os.path.exists(tempdir):
             os.makedirs(tempdir)
 
-        out_ds = gdal.GetDriverByName(driver_name).Create(name, x_res, y_res, nbands, data_type)
+        return driver_name, name, options
+
+    def create_ds(self, name, x_res, y_res, nbands, data_type, scratch=None):
+        """ Create a new dataset
+        :param scratch: (driver_name, name, options) already selected with scratch_driver. Selected if not defined.
+        """
+
+        if scratch is None:
+            nbytes = x_res * y_res * nbands * gdal.GetDataTypeSize(data_type) / 8
+            scratch = self.scratch_driver(name, nbytes=nbytes)
+
+        driver_name, name, options = scratch
+
+        out_ds = gdal.GetDriverByName(driver_name).Create(name, x_res, y_res, nbands, data_type, options=options)
         out_ds.SetMetadataItem('FilePath', name)
 
         if not self.gdal2ds(out_ds, check_proj=False):
@@ -265,17 +613,73 @@ class GdalReader:
 
         return out_ds
 
-    def array2ds(self, src_array, output, mask_ds=None, geotransform=None, projection=None, nodata=None):
+    @staticmethod
+    def mem_buffer(src_ds):
+        """ Numpy buffer wrapped by a MEM dataset (see array2mem). None for any other dataset."""
+
+        try:
+            return MEM_BUFFERS.get(src_ds)
+
+        except TypeError:
+            return
+
+    def array2mem(self, array, name=''):
+        """ Wrap a 3D array (bands, rows, cols) as a MEM dataset without copying the data (DATAPOINTER).
+        The dataset keeps a reference to the array, so the buffer is released together with the dataset.
+        Note that the array and the dataset share the same memory.
+        """
+
+        if array.dtype.name not in self.np2gdal or array.dtype.name == 'int8':
+            # Data type not supported by GDAL. It requires a conversion.
+            return
+
+        array = np.ascontiguousarray(array)
+        nbands, ysize, xsize = array.shape
+        itemsize = array.dtype.itemsize
+
+        mem_path = ('MEM:::DATAPOINTER=0x%x,PIXELS=%d,LINES=%d,BANDS=%d,DATATYPE=%s,'
+                    'PIXELOFFSET=%d,LINEOFFSET=%d,BANDOFFSET=%d' %
+                    (array.__array_interface__['data'][0], xsize, ysize, nbands,
+                     gdal.GetDataTypeName(self.np2gdal[array.dtype.name]),
+                     itemsize, itemsize * xsize, itemsize * xsize * ysize))
+
+        # Required to open MEM datasets in recent GDAL versions
+        gdal.SetConfigOption('GDAL_MEM_ENABLE_OPEN', 'YES')
+        out_ds = gdal.Open(mem_path, GA_Update)
+
+        try:
+            MEM_BUFFERS[out_ds] = array
+
+        except TypeError:
+            # The buffer cannot be linked to the dataset
+            return
+
+        out_ds.SetMetadataItem('FilePath', name)
+
+        return out_ds
+
+    def array2ds(self, src_array, output, mask_ds=None, geotransform=None, projection=None, nodata=None,
+                 copy=True):
+        """ Create a new dataset from a 2D (single band) or 3D (multiple bands) array.
+        :param copy: Boolean. If False and the dataset is created in memory, the array is wrapped without copying it
+        (the dataset and the array share the same memory).
+        """
+
+        src_array = np.asarray(src_array)
+
+        # Floats are stored in the working precision
+        if src_array.dtype.kind == 'f' and not src_array.dtype == numpy_tools.working_dtype():
+            src_array = src_array.astype(numpy_tools.working_dtype())
 
         # Size and bands
-        if np.array(src_array).ndim == 2:
+        if src_array.ndim == 2:
             nbands = 1
             xsize = len(src_array[0])
             ysize = len(src_array)
-            array = np.array([src_array])
+            array = src_array[np.newaxis]
             dtype = self.np2type(src_array)
 
-        elif np.array(src_array).ndim == 3:
+        elif src_array.ndim == 3:
             nbands = len(src_array)
             xsize = len(src_array[0][0])
             ysize = len(src_array[0])
@@ -307,7 +711,16 @@ class GdalReader:
                 return
 
         # Create dataset
-        out_ds = self.create_ds(output, xsize, ysize, nbands, dtype)
+        out_ds = None
+        scratch = None
+        if not copy:
+            scratch = self.scratch_driver(output, nbytes=array.nbytes)
+            if scratch[0] == 'MEM':
+                out_ds = self.array2mem(array, name=scratch[1])
+
+        if out_ds is None:
+            out_ds = self.create_ds(output, xsize, ysize, nbands, dtype, scratch=scratch)
+
         out_ds.SetGeoTransform(geotransform)
         out_ds.SetProjection(projection)
 
@@ -324,9 +737,11 @@ class GdalReader:
         # array[array == np.nan] = nodata
 
         # Write bands
+        wrapped = self.mem_buffer(out_ds) is not None
         for bid in xrange(nbands):
             band = out_ds.GetRasterBand(bid + 1)
-            band.WriteArray(array[bid], 0, 0)
+            if not wrapped:
+                band.WriteArray(array[bid], 0, 0)
             out_ds.GetRasterBand(bid + 1).SetNoDataValue(nodata)
             band.FlushCache()
 
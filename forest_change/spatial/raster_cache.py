@@ -0,0 +1,149 @@
+# /usr/bin/env python
+
+# PRODUCT: EO4Atlantic
+# MODULE: raster_cache.py
+# AUTHOR: Treemetrics
+# DESCRIPTION: 	Process-wide cache of raster arrays
+
+# COPYRIGHT:	(C) 2018 Treemetrics. All rights reserved.
+# ==========================================================================================
+""" Process-wide LRU cache of raster arrays limited by size in bytes and persistent statistics sidecars"""
+
+import collections
+import json
+import logging
+import os
+import threading
+
+from core.bunch import Config
+
+
+class ArrayCache(object):
+    """ LRU cache of numpy arrays. The least recently used arrays are evicted when the total size exceeds
+    the budget (Config()['array_cache_size'] in MB if max_bytes is not defined).
+    Note that cached arrays are shared, so they must not be modified in place.
+    """
+
+    def __init__(self, max_bytes=None):
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._arrays = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def budget(self):
+        """ Size limit of the cache in bytes"""
+
+        if self.max_bytes is not None:
+            return self.max_bytes
+
+        return int(float(Config().get('array_cache_size', 1024)) * 1024 ** 2)
+
+    def get(self, key):
+
+        with self._lock:
+            array = self._arrays.pop(key, None)
+
+            if array is not None:
+                # Most recently used
+                self._arrays[key] = array
+
+            return array
+
+    def put(self, key, array):
+        """ Store the array and return it. Arrays larger than the budget are not stored."""
+
+        budget = self.budget()
+
+        with self._lock:
+            if key in self._arrays:
+                self.nbytes -= self._arrays.pop(key).nbytes
+
+            if array.nbytes > budget:
+                logging.debug('Array is larger than the cache size. It is not cached: ' + str(key))
+                return array
+
+            self._arrays[key] = array
+            self.nbytes += array.nbytes
+
+            # Evict least recently used
+            while self.nbytes > budget:
+                old_key, old_array = self._arrays.popitem(last=False)
+                self.nbytes -= old_array.nbytes
+                logging.debug('Array evicted from cache: ' + str(old_key))
+
+        return array
+
+    def discard(self, prefix):
+        """ Remove all the arrays whose key starts with the prefix"""
+
+        with self._lock:
+            for key in [k for k in self._arrays.keys() if k[0] == prefix]:
+                self.nbytes -= self._arrays.pop(key).nbytes
+
+    def clear(self):
+
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+
+ARRAY_CACHE = ArrayCache()
+
+
+def sidecar_path(file_path):
+    """ Path of the statistics sidecar of a raster file"""
+
+    return file_path + '.stats.json'
+
+
+def _read_sidecar(file_path, key):
+    """ Statistics entries of the sidecar. Empty if the sidecar does not exist or it was created with a different
+    key (e.g. the raster was modified)."""
+
+    path = sidecar_path(file_path)
+    if not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path) as sidecar:
+            content = json.load(sidecar)
+
+    except (IOError, ValueError):
+        logging.warning('Statistics sidecar cannot be read: ' + str(path))
+        return {}
+
+    # Tuples are stored as lists
+    if not content.get('key') == json.loads(json.dumps(key)):
+        logging.debug('Statistics sidecar is outdated: ' + str(path))
+        return {}
+
+    return content.get('stats') or {}
+
+
+def load_stats(file_path, key, entry):
+    """ Statistics stored in the sidecar of the raster file. None if not found or the sidecar was created with
+    a different key.
+    :param file_path: raster file path
+    :param key: JSON serializable key of the file version (e.g. file fingerprint)
+    :param entry: name of the statistics in the sidecar (e.g. histogram bins and bands)
+    """
+
+    return _read_sidecar(file_path, key).get(entry)
+
+
+def save_stats(file_path, key, entry, stats):
+    """ Store the statistics in a sidecar next to the raster file (see load_stats). The other entries of the same
+    file version are kept."""
+
+    entries = _read_sidecar(file_path, key)
+    entries[entry] = stats
+
+    path = sidecar_path(file_path)
+
+    try:
+        with open(path, 'w') as sidecar:
+            json.dump({'key': key, 'stats': entries}, sidecar)
+
+    except (IOError, OSError):
+        logging.warning('Statistics sidecar cannot be written: ' + str(path))
@@ -9,7 +9,7 @@
 # ==========================================================================================
 
 # Import modules
-import numpy as np
+from collections import namedtuple
 
 from spatial.gdal_reader import GdalReader
 
@@ -25,7 +25,12 @@ except ImportError:
     import osr
     import ogr
 
-from osgeo import gdal_array
+
+# Lightweight tile descriptor (window in pixels and geotransform of the tile). No pixel data.
+# The halo is the number of extra pixels read on each side of the tile (left, top, right, bottom).
+# The type is named as the module attribute, so tiles can be pickled and shipped to worker processes.
+tile_tuple = namedtuple('tile_tuple', ['name', 'xtile', 'ytile', 'xoff', 'yoff', 'xsize', 'ysize', 'geotransform',
+                                       'halo'])
 
 
 def get_number_tiles(src, tile_size=500):
@@ -35,94 +40,152 @@ def get_number_tiles(src, tile_size=500):
     xsize = src_ds.RasterXSize
     ysize = src_ds.RasterYSize
 
-    if np.round(xsize / tile_size, 0) - (xsize / tile_size) == 0.0:
-        nxtiles = np.round(xsize / tile_size, 0)
-
-    else:
-        nxtiles = np.round(xsize / tile_size, 0) + 1
-
-    if np.round(ysize / tile_size, 0) - (ysize / tile_size) == 0.0:
-        nytiles = np.round(ysize / tile_size, 0)
-
-    else:
-        nytiles = np.round(ysize / tile_size, 0) + 1
+    # Ceil of integer division
+    nxtiles = (xsize + tile_size - 1) // tile_size
+    nytiles = (ysize + tile_size - 1) // tile_size
 
     return nxtiles, nytiles
 
 
-def gdal2tiles(src, tile_size=500, tile_id_y=None, tile_id_x=None):
-    """ Load a gdal file to local python instance
-    
+def tile_windows(src, tile_size=500, tile_id_y=None, tile_id_x=None, halo=0):
+    """ Yield the tile descriptors row by row (no pixel data is read)
+
     :param src: source gdal dataset
     :param tile_size: Tile size
     :param tile_id_y: Single tile ID for Y
     :param tile_id_x: Single tile ID for X
+    :param halo: Number of overlapping pixels read on every side of the tile (limited by the raster edges)
     """
 
     src_ds = gdal_import.src2ds(src)
     xsize = src_ds.RasterXSize
     ysize = src_ds.RasterYSize
-    bands = src_ds.RasterCount
-    nxtiles, nytiles = get_number_tiles(src_ds)
-
-    # Read raster as arrays
-    dtype = [key for key, value in GdalReader().np2gdal.iteritems() if value == src_ds.GetRasterBand(1).DataType][0]
+    geotransform = src_ds.GetGeoTransform()
+    nxtiles, nytiles = get_number_tiles(src_ds, tile_size=tile_size)
 
-    if tile_id_x and str(tile_id_x).isdigit() and tile_id_y and str(tile_id_y).isdigit():
-        x_tile_range = [tile_id_x]
-        y_tile_range = [tile_id_y]
+    if str(tile_id_x).isdigit() and str(tile_id_y).isdigit():
+        x_tile_range = [int(tile_id_x)]
+        y_tile_range = [int(tile_id_y)]
 
     else:
-        x_tile_range = range(nxtiles + 1)
-        y_tile_range = range(nytiles + 1)
+        x_tile_range = xrange(nxtiles)
+        y_tile_range = xrange(nytiles)
+
+    for ytile in y_tile_range:
+        for xtile in x_tile_range:
+
+            xoff = tile_size * xtile
+            yoff = tile_size * ytile
+            win_xsize = min(tile_size, xsize - xoff)
+            win_ysize = min(tile_size, ysize - yoff)
+
+            if win_xsize <= 0 or win_ysize <= 0:
+                # Out of the raster
+                continue
 
-    tiles = {}
-    for xtile in x_tile_range:
-        for ytile in y_tile_range:
+            # Geotransform
+            top_left_x = geotransform[0] + geotransform[1] * xoff + geotransform[2] * yoff
+            top_left_y = geotransform[3] + geotransform[5] * yoff + geotransform[4] * xoff
+
+            tile_geotransform = [top_left_x, geotransform[1], geotransform[2],
+                                 top_left_y, geotransform[4], geotransform[5]]
 
-            # DatasetReadAsArray(ds, xoff=0, yoff=0, win_xsize=None, win_ysize=None)
+            # Overlap with the neighbour tiles
+            tile_halo = (min(halo, xoff), min(halo, yoff),
+                         min(halo, xsize - xoff - win_xsize), min(halo, ysize - yoff - win_ysize))
 
-            if (tile_size * xtile + tile_size) < xsize and (tile_size * ytile + tile_size) < ysize:
+            yield tile_tuple(name=str(xtile) + '_' + str(ytile), xtile=xtile, ytile=ytile, xoff=xoff, yoff=yoff,
+                             xsize=win_xsize, ysize=win_ysize, geotransform=tile_geotransform, halo=tile_halo)
 
-                # arr_i = np.array(gdal_array.DatasetReadAsArray(src_ds, xoff=tile_size * xtile, yoff=tile_size * ytile,
-                # win_xsize=tile_size, win_ysize=tile_size)).astype(dtype)
 
-                arr_i = np.array(gdal_array.DatasetReadAsArray(src_ds, tile_size * xtile, tile_size * ytile,
-                                                               tile_size, tile_size)).astype(dtype)
+def read_tile(src, tile):
+    """ Read the pixels of a tile (including the halo) as a new dataset
 
-            else:
+    :param src: source gdal dataset
+    :param tile: tile descriptor (see tile_windows)
+    """
 
-                win_xsize = min(tile_size, xsize - tile_size * xtile)
-                win_ysize = min(tile_size, ysize - tile_size * ytile)
+    src_ds = gdal_import.src2ds(src)
+    left, top, right, bottom = tile.halo
 
-                if win_xsize < 0 or win_ysize < 0:
-                    # Not square shape
-                    continue
+    window = GdalReader().window_tuple(xoff=tile.xoff - left, yoff=tile.yoff - top,
+                                       xsize=tile.xsize + left + right, ysize=tile.ysize + top + bottom)
+    arr_i = GdalReader().read_array(src_ds, window=window)
 
-                # arr_src = np.array(gdal_array.DatasetReadAsArray(src_ds, xoff=tile_size * xtile,
-                # yoff=tile_size * ytile, win_xsize=win_xsize, win_ysize=win_ysize)).astype(dtype)
-                arr_src = np.array(gdal_array.DatasetReadAsArray(src_ds, tile_size * xtile, tile_size * ytile,
-                                                                 win_xsize, win_ysize)).astype(dtype)
+    # Geotransform of the tile with halo
+    geotransform = list(tile.geotransform)
+    geotransform[0] -= geotransform[1] * left + geotransform[2] * top
+    geotransform[3] -= geotransform[5] * top + geotransform[4] * left
 
-                arr_i = np.zeros((bands, win_ysize, win_xsize), dtype=dtype)
-                arr_i[:, 0:arr_src.shape[1], 0:arr_src.shape[2]] = arr_src
+    # Scratch name (no directory), so the tile is created in memory within the memory budget
+    return GdalReader().array2ds(arr_i, 'tile_' + tile.name, geotransform=geotransform,
+                                 projection=src_ds.GetProjection(),
+                                 nodata=src_ds.GetRasterBand(1).GetNoDataValue(), copy=False)
 
-            # Create raster
-            # Geotransform
-            geotransform = src_ds.GetGeoTransform()
-            top_left_x = geotransform[0] + geotransform[1] * tile_size * xtile + geotransform[2] * tile_size * ytile
-            top_left_y = geotransform[3] + geotransform[5] * tile_size * ytile + geotransform[4] * tile_size * xtile
 
-            new_geotransform = [top_left_x, geotransform[1], geotransform[2],
-                                top_left_y, geotransform[4], geotransform[5]]
+def crop_tile(src, tile):
+    """ Crop the core region of a tile (without halo) from a processed tile dataset. The crop is located
+    by geotransform, so the processed dataset can be smaller than the tile (e.g. clipped to polygons).
+    None if the dataset does not overlap the core region.
+
+    :param src: processed tile dataset
+    :param tile: tile descriptor (see tile_windows)
+    """
+
+    src_ds = gdal_import.src2ds(src)
+
+    if not any(tile.halo):
+        return src_ds
 
-            projection = src_ds.GetProjection()
-            nodata = src_ds.GetRasterBand(1).GetNoDataValue()
-            name = src_ds.GetMetadataItem('FilePath')
+    geotransform = src_ds.GetGeoTransform()
 
-            tiles[str(xtile) + '_' + str(ytile)] = GdalReader().array2ds(arr_i,
-                                                                         name + '_' + str(xtile) + '_' + str(ytile),
-                                                                         geotransform=new_geotransform,
-                                                                         projection=projection)
+    # Core region in pixels of the processed dataset
+    xoff = int(round((tile.geotransform[0] - geotransform[0]) / geotransform[1]))
+    yoff = int(round((tile.geotransform[3] - geotransform[3]) / geotransform[5]))
+
+    x_min, y_min = max(0, xoff), max(0, yoff)
+    x_max = min(src_ds.RasterXSize, xoff + tile.xsize)
+    y_max = min(src_ds.RasterYSize, yoff + tile.ysize)
+
+    if x_max <= x_min or y_max <= y_min:
+        return
+
+    window = GdalReader().window_tuple(xoff=x_min, yoff=y_min, xsize=x_max - x_min, ysize=y_max - y_min)
+    arr_i = GdalReader().read_array(src_ds, window=window)
+
+    geotransform = list(geotransform)
+    geotransform[0] += geotransform[1] * x_min + geotransform[2] * y_min
+    geotransform[3] += geotransform[5] * y_min + geotransform[4] * x_min
+
+    return GdalReader().array2ds(arr_i, 'tile_' + tile.name + '_core', geotransform=geotransform,
+                                 projection=src_ds.GetProjection(),
+                                 nodata=src_ds.GetRasterBand(1).GetNoDataValue(), copy=False)
+
+
+def iter_tiles(src, tile_size=500, tile_id_y=None, tile_id_x=None, halo=0):
+    """ Yield (tile descriptor, tile dataset) in streaming order. Each tile is read only when it is consumed.
+
+    :param src: source gdal dataset
+    :param tile_size: Tile size
+    :param tile_id_y: Single tile ID for Y
+    :param tile_id_x: Single tile ID for X
+    :param halo: Number of overlapping pixels read on every side of the tile
+    """
+
+    for tile in tile_windows(src, tile_size=tile_size, tile_id_y=tile_id_y, tile_id_x=tile_id_x, halo=halo):
+        yield tile, read_tile(src, tile)
+
+
+def gdal2tiles(src, tile_size=500, tile_id_y=None, tile_id_x=None, halo=0):
+    """ Load a gdal file to local python instance. Note that all the tiles are loaded in memory
+    (see iter_tiles for streaming).
+
+    :param src: source gdal dataset
+    :param tile_size: Tile size
+    :param tile_id_y: Single tile ID for Y
+    :param tile_id_x: Single tile ID for X
+    :param halo: Number of overlapping pixels read on every side of the tile
+    """
 
-    return tiles
+    return dict((tile.name, tile_ds) for tile, tile_ds in iter_tiles(src, tile_size=tile_size, tile_id_y=tile_id_y,
+                                                                      tile_id_x=tile_id_x, halo=halo))
@@ -0,0 +1,52 @@
+# /usr/bin/env python
+
+# PROJECT:	    EO4Atlantic
+# MODULE:		test_raster_tiles.py
+# AUTHOR:		Treemetrics
+# DESCRIPTION: 	Tests of the raster tiling
+
+# COPYRIGHT:	(C) 2018 Treemetrics all rights reserved.
+# ==========================================================================================
+
+import multiprocessing
+import os
+import pickle
+import sys
+import unittest
+
+# Modules are imported relative to the forest_change directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spatial import raster_tiles
+
+
+def _tile_name(tile):
+    return tile.name
+
+
+class TestTileDescriptor(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tile = raster_tiles.tile_tuple(name='1_2', xtile=1, ytile=2, xoff=500, yoff=1000, xsize=500,
+                                            ysize=500, geotransform=[0.0, 10.0, 0.0, 0.0, 0.0, -10.0],
+                                            halo=(8, 8, 8, 0))
+
+    def test_pickle(self):
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(self.tile, protocol)), self.tile)
+
+    def test_pool(self):
+
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(pool.map(_tile_name, [self.tile, self.tile]), ['1_2', '1_2'])
+
+        finally:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
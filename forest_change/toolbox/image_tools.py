@@ -15,11 +15,25 @@ import numpy as np
 from spatial.gdal_reader import GdalReader
 
 import numpy_tools as tools
+import raster_tools
+from core.bunch import Config
 from spatial import gdal_import
 
+try:
+    from osgeo import gdal_array
+
+except ImportError:
+    import gdal_array
+
 
 class RasterTools(object):
 
+    # Band numbers of RGBN rasters
+    RED = 1
+    GREEN = 2
+    BLUE = 3
+    NIR = 4
+
     # def _import2py(self, src_dataset, memory=False):
     #     """ Import gdal dataset to python.
     #     :param src_dataset: source gdal dataset
@@ -30,100 +44,313 @@ class RasterTools(object):
     def _array2raster(self, src_array, name, mask):
         """ Provide the right format to PY/GDAL outputs"""
 
-        return GdalReader().array2ds(src_array, name, mask_ds=mask)
+        return GdalReader().array2ds(src_array, name, mask_ds=gdal_import.src2ds(mask), copy=False)
+
+    def _blocks2raster(self, function, input_raster, name, chunk_shape, bands=None, nodata=None):
+        """ Apply the function window by window (peak memory bounded by the chunk size)"""
+
+        src_ds = gdal_import.src2ds(input_raster)
+        blocks = ((window, function(block))
+                  for window, block in GdalReader().iter_blocks(src_ds, chunk_shape, bands=bands))
 
-    def equalization(self, input_raster):
-        """Equalization of a 2D array with finite values
-        :param input_raster 2D array"""
+        return GdalReader().blocks2ds(blocks, name, mask_ds=src_ds, nodata=nodata)
+
+    @staticmethod
+    def _chunk_shape(chunk_shape):
+        """ Chunk shape (rows, cols) for block processing. None if the full raster is processed at once."""
+
+        if chunk_shape is None:
+            return Config().get('chunk_shape')
+
+        return chunk_shape
+
+    def equalization(self, input_raster, luts=None):
+        """Equalization of the raster bands
+        :param input_raster: raster
+        :param luts: lookup tables of the bands (see equalization_luts) to use the same equalization for all the
+        tiles of a scene. Optional."""
 
         logging.debug('Starting equalization... ')
 
         src_ds = gdal_import.src2ds(input_raster)
-        raster_arrays = GdalReader().ds2array(src_ds)
-        d_bands = tools.equalization(bands_list=raster_arrays)
+        nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+
+        raster_arrays = gdal_import.src2array(input_raster)
+        d_bands = tools.equalization(bands_list=raster_arrays, nodata=nodata, luts=luts)
         # return gdal_import.gdal_import(toolbox.raster.gdal_utils.poly_clip(raster, polygons, output))
 
         return self._array2raster(d_bands, name='equalization', mask=input_raster)
 
-    def normalisation(self, input_raster):
-        """Normalisation of a 2D array to 0-255 
-        :param input_raster 2D array"""
+    def equalization_luts(self, input_raster, chunk_shape=None):
+        """ Equalization lookup tables of each band accumulated block by block (e.g. for a full scene before
+        processing the tiles). Only integer bands (uint8/uint16) are streamed, other bands are read at once.
+        """
+
+        src_ds = gdal_import.src2ds(input_raster)
+        nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+
+        chunk_shape = self._chunk_shape(chunk_shape)
+
+        luts = []
+        for band in xrange(1, src_ds.RasterCount + 1):
+            dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(src_ds.GetRasterBand(band).DataType))
+
+            if dtype.name not in ('uint8', 'uint16'):
+                luts.append(tools.equalization_lut(gdal_import.src2array(input_raster, bands=[band]), nodata=nodata))
+                continue
+
+            counts = np.zeros(np.iinfo(dtype).max + 1, dtype=np.int64)
+            for window, block in GdalReader().iter_blocks(src_ds, chunk_shape, bands=[band]):
+                counts += tools.integer_histogram(block, nodata=nodata)
+
+            luts.append(tools.equalization_lut(counts=counts, dtype=dtype, nodata=nodata))
+
+        return luts
+
+    def normalisation(self, input_raster, percentiles=None, chunk_shape=None, dtype='uint8'):
+        """Normalisation of the raster bands to 0-255 with a percentile stretch. The percentiles of each band are
+        computed from streaming histograms and the stretch is applied block by block.
+        :param input_raster: raster
+        :param percentiles: (low, high) percentiles (Config()['normalisation_percentiles'] or 2 and 98 by default)
+        :param chunk_shape: (rows, cols) of the blocks (Config()['chunk_shape'] by default)
+        :param dtype: output data type"""
 
         logging.debug('Starting normalisation... ')
 
         src_ds = gdal_import.src2ds(input_raster)
-        raster_arrays = GdalReader().ds2array(src_ds)
+        src_nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+
+        # Input nodata is masked. The output nodata must be a valid output value.
+        out_nodata = src_nodata
+        if out_nodata is None or np.isnan(out_nodata) or (np.dtype(dtype).kind in 'ui' and
+                                                          not 0 <= out_nodata <= np.iinfo(np.dtype(dtype)).max):
+            out_nodata = 0
+
+        if percentiles is None:
+            percentiles = Config().get('normalisation_percentiles', (2, 98))
+
+        limits = []
+        for band in xrange(1, src_ds.RasterCount + 1):
+            stats = raster_tools.raster_histogram(input_raster, bands=[band])
+            limits.append((0, 0) if stats is None else tuple(stats.percentile(percentiles)))
+
+        chunk_shape = self._chunk_shape(chunk_shape) or (1024, 1024)
+
+        def stretch(block):
+            d_bands = tools.normalisation(block, nodata=src_nodata, limits=limits, dtype=dtype,
+                                          out_nodata=out_nodata)
+            return d_bands[0] if block.ndim == 2 else d_bands
+
+        return self._blocks2raster(stretch, input_raster, name="normalization", chunk_shape=chunk_shape,
+                                   nodata=out_nodata)
+
+    def nir(self, input_raster, chunk_shape=None):
+
+        chunk_shape = self._chunk_shape(chunk_shape)
+        if chunk_shape:
+            return self._blocks2raster(lambda block: block, input_raster, name="nir", chunk_shape=chunk_shape,
+                                       bands=[self.NIR])
+
+        raster_array = gdal_import.src2array(input_raster, bands=[self.NIR])
+        return self._array2raster(raster_array, name="nir", mask=input_raster)
+
+    def histogram_matching(self, input_raster, reference, output='histogram_matching', chunk_shape=None,
+                           lut=None):
+        """ Match the histogram of the raster to the histogram of the reference. The lookup table is fitted from
+        the streaming histograms of both rasters and applied block by block (see numpy_tools.HistogramLUT).
+        :param input_raster: raster to be modified
+        :param reference: raster with the reference distribution
+        :param chunk_shape (rows, cols) to process the raster by blocks (optional)
+        :param lut: lookup table already fitted (e.g. for other tiles of the same scene). Optional.
+        """
 
-        nodata = src_ds.GetRasterBand(1).GetNoDataValue()
-        d_bands = tools.normalisation(raster_arrays, nodata=nodata)
-        return self._array2raster(d_bands, name="normalization", mask=input_raster)
+        logging.debug('Starting histogram_matching... ')
 
-    def nir(self, input_raster):
         src_ds = gdal_import.src2ds(input_raster)
-        raster_array = GdalReader().ds2array(src_ds)
-        return self._array2raster(raster_array[3], name="nir", mask=input_raster)
+        nodata = src_ds.GetRasterBand(1).GetNoDataValue()
 
-    def histogram_matching(self, input_raster, reference, output='histogram_matching'):
+        if lut is None:
+            lut = self.histogram_lut(input_raster, reference)
 
-        logging.debug('Starting histogram_matching... ')
+        if lut is None:
+            return
 
-        src_ds = gdal_import.src2ds(input_raster)
-        raster_array = GdalReader().ds2array(src_ds)
+        chunk_shape = self._chunk_shape(chunk_shape)
+        if chunk_shape:
+            return self._blocks2raster(lambda block: lut.apply(block, nodata=nodata), input_raster, name=output,
+                                       chunk_shape=chunk_shape)
 
-        ref_ds = gdal_import.src2ds(reference)
-        ref_array = GdalReader().ds2array(ref_ds)
-        nodata = ref_ds.GetRasterBand(1).GetNoDataValue()
+        raster_array = gdal_import.src2array(input_raster)
 
-        matched_array= tools.histogram_matching(raster_array, ref_array, nodata=nodata)
+        matched_array = lut.apply(raster_array, nodata=nodata)
         return self._array2raster(matched_array, name=output, mask=input_raster)
 
-    def rgb_intensity(self, input_raster):
+    @staticmethod
+    def histogram_lut(input_raster, reference, bins=1024):
+        """ Lookup table matching the histogram of the raster to the reference (see numpy_tools.HistogramLUT)"""
+
+        source_stats = raster_tools.raster_histogram(input_raster, bins=bins)
+        reference_stats = raster_tools.raster_histogram(reference, bins=bins)
+
+        if source_stats is None or reference_stats is None:
+            logging.warning('Histogram matching aborted. Rasters do not have valid values')
+            return
+
+        return tools.HistogramLUT.from_stats(source_stats, reference_stats)
+
+    def rgb_intensity(self, input_raster, chunk_shape=None):
         """ Intensity for rgb images 
         :param input_raster dictionary with the RGB bands
+        :param chunk_shape (rows, cols) to process the raster by blocks (optional)
         """
         logging.debug('Starting rgb_intensity... ')
 
-        src_ds = gdal_import.src2ds(input_raster)
-        raster_array = GdalReader().ds2array(src_ds)
+        bands = [self.RED, self.GREEN, self.BLUE]
+
+        chunk_shape = self._chunk_shape(chunk_shape)
+        if chunk_shape:
+            return self._blocks2raster(tools.rgb_intensity, input_raster, name='intensity', chunk_shape=chunk_shape,
+                                       bands=bands)
+
+        raster_array = gdal_import.src2array(input_raster, bands=bands)
 
         intensity = tools.rgb_intensity(raster_array)
         return self._array2raster(intensity, name='intensity', mask=input_raster)
 
-    def vegetation_index(self, input_raster):
+    @staticmethod
+    def _ndvi(raster_bands):
+        """ NDVI from the [RED, NIR] bands"""
+
+        return tools.vegetation_index(red=raster_bands[0], green=None, nir=raster_bands[1])
+
+    @staticmethod
+    def _grvi(raster_bands):
+        """ GRVI from the [RED, GREEN] bands"""
+
+        return tools.vegetation_index(red=raster_bands[0], green=raster_bands[1])
+
+    def vegetation_index(self, input_raster, chunk_shape=None):
         """ Vegetation Index (GRVI, NDVI) for rgb/rgbnir images 
         :param input_raster dictionary with the RGB bands
+        :param chunk_shape (rows, cols) to process the raster by blocks (optional)
         """
         logging.debug('Starting vegetation_index... ')
 
         src_ds = gdal_import.src2ds(input_raster)
-        raster_bands = GdalReader().ds2array(src_ds)
 
-        if len(raster_bands) == 3:
-            vi = tools.vegetation_index(red=raster_bands[0], green=raster_bands[1])
+        # Only the bands required for the index are read
+        if src_ds.RasterCount >= 4:
+            function = self._ndvi
+            bands = [self.RED, self.NIR]
 
-        elif len(raster_bands) >= 4:
-            vi = tools.vegetation_index(red=raster_bands[0], green=raster_bands[1], nir=raster_bands[3])
+        elif src_ds.RasterCount == 3:
+            function = self._grvi
+            bands = [self.RED, self.GREEN]
 
         else:
             logging.warning('Not enough bands to create vegetation index.')
             return
 
+        chunk_shape = self._chunk_shape(chunk_shape)
+        if chunk_shape:
+            return self._blocks2raster(function, src_ds, name='vi', chunk_shape=chunk_shape, bands=bands)
+
+        raster_bands = gdal_import.src2array(input_raster, bands=bands)
+        vi = function(raster_bands)
+
         return self._array2raster(vi, name='vi', mask=input_raster)
 
-    def zonal_stats(self, raster, zones, resize=True):
+    @staticmethod
+    def _read_bands(input_raster, bands, window=None):
+        """ List of 2D arrays with the bands. Lazy rasters are read from the cache without stacking the bands."""
+
+        if window is None and isinstance(input_raster, gdal_import.LazyGdal2Py):
+            return [input_raster.read(bands=[band]) for band in bands]
+
+        array = GdalReader().read_array(gdal_import.src2ds(input_raster), bands=bands, window=window)
+        return [array] if array.ndim == 2 else list(array)
+
+    def _change_bands(self, method, band_count):
+        """ Method and bands required by the change kernel (see numpy_tools.change_kernel)"""
+
+        method = method.lower()
+
+        if method not in ('ndvi', 'intensity', 'nir'):
+            raise Exception("Change detection method not defined")
+
+        if method == 'ndvi' and band_count >= 4:
+            return 'ndvi', [self.RED, self.NIR]
+
+        elif method == 'ndvi' and band_count == 3:
+            return 'grvi', [self.RED, self.GREEN]
+
+        elif method == 'intensity' and band_count >= 3:
+            return 'intensity', [self.RED, self.GREEN, self.BLUE]
+
+        elif method == 'nir' and band_count >= 4:
+            return 'nir', [self.NIR]
+
+        logging.warning('Not enough bands for the change detection method: ' + str(method))
+        return method, None
+
+    def change_index(self, input_raster1, input_raster2, method='ndvi', chunk_shape=None):
+        """ Difference of the change index (NDVI/GRVI, intensity or NIR) between two dates. The index of both
+        dates and the difference are computed in one pass without intermediate rasters.
+        :param input_raster1: RGBN raster of the first date
+        :param input_raster2: RGBN raster of the second date (same grid than the first date)
+        :param method: 'ndvi', 'intensity' or 'nir'
+        :param chunk_shape (rows, cols) to process the raster by blocks (optional)
+        """
+
+        logging.debug('Starting change_index... ')
+
+        src1_ds = gdal_import.src2ds(input_raster1)
+        src2_ds = gdal_import.src2ds(input_raster2)
+
+        kernel, bands = self._change_bands(method, min(src1_ds.RasterCount, src2_ds.RasterCount))
+        if not bands:
+            return
+
+        chunk_shape = self._chunk_shape(chunk_shape)
+        if chunk_shape:
+            # Both dates are read with the windows of the first date
+            blocks = ((window, tools.change_kernel(self._read_bands(src1_ds, bands, window),
+                                                   self._read_bands(src2_ds, bands, window), method=kernel))
+                      for window in GdalReader().block_windows(src1_ds, chunk_shape))
+
+            return GdalReader().blocks2ds(blocks, 'change_' + kernel, mask_ds=src1_ds)
+
+        change = tools.change_kernel(self._read_bands(input_raster1, bands), self._read_bands(input_raster2, bands),
+                                     method=kernel)
+
+        return self._array2raster(change, name='change_' + kernel, mask=input_raster1)
+
+    def zonal_stats(self, raster, zones, resize=True, chunk_shape=None):
+        """ Statistics of the raster values for each zone (count, mean and stdev rasters) and the table of
+        statistics by zone ('table')
+        :param raster: raster with the values (first band)
+        :param zones: raster with the zone IDs (first band)
+        :param resize: Boolean. Use the common area if the rasters have different size
+        :param chunk_shape (rows, cols) to process the raster by blocks (optional)
+        """
 
         logging.debug('Starting zonal_stats... ')
 
+        chunk_shape = self._chunk_shape(chunk_shape)
+        if chunk_shape:
+            return self._zonal_stats_blocks(raster, zones, resize=resize, chunk_shape=chunk_shape)
+
         src_ds = gdal_import.src2ds(raster)
-        raster_array = GdalReader().ds2array(src_ds)
+        raster_array = gdal_import.src2array(raster, bands=[1])
+        zones_array = gdal_import.src2array(zones, bands=[1])
 
-        zones_ds = gdal_import.src2ds(zones)
-        zones_array = GdalReader().ds2array(zones_ds)
+        outputs = tools.zonal_stats(valuesarr=raster_array, zonesarr=zones_array, resize=resize,
+                                    values_nodata=src_ds.GetRasterBand(1).GetNoDataValue())
 
-        outputs = tools.zonal_stats(valuesarr=raster_array[0], zonesarr=zones_array[0],
-                                    resize=resize)
+        if outputs is None:
+            return
 
-        outputs_dict = {}
+        outputs_dict = {'table': outputs['table']}
         name = 'stats'
         for stat in ['count', 'mean', 'stdev']:
             outputs_dict[str(stat)] = (self._array2raster(outputs[stat], name=str(name + '_' + str(stat)),
@@ -131,13 +358,39 @@ class RasterTools(object):
 
         return outputs_dict
 
+    def _zonal_stats_blocks(self, raster, zones, resize=True, chunk_shape=None):
+        """ Zonal statistics accumulated block by block (see raster_tools.zonal_accumulator). The rasters of each
+        statistic are written block by block."""
+
+        accumulator = raster_tools.zonal_accumulator(raster, zones, resize=resize, chunk_shape=chunk_shape)
+        if accumulator is None:
+            return
+
+        src_ds = gdal_import.src2ds(raster)
+        zones_ds = gdal_import.src2ds(zones)
+        windows = raster_tools.zone_windows(src_ds, zones_ds, resize=resize, chunk_shape=chunk_shape)
+
+        table = accumulator.table()
+        outputs_dict = {'table': table}
+
+        for stat in ['count', 'mean', 'stdev']:
+            blocks = ((window, accumulator.broadcast(GdalReader().read_array(zones_ds, bands=[1], window=window),
+                                                     stat=stat, table=table))
+                      for window in windows)
+
+            outputs_dict[stat] = GdalReader().blocks2ds(blocks, 'stats_' + stat, mask_ds=src_ds)
+
+        return outputs_dict
+
     def single_band_calculator(self, rlist, expression):
-        """ Raster calculator """
+        """ Raster calculator. It can be called concurrently (e.g. from parallel tiles).
+        :param rlist: list of rasters (a, b, c...)
+        :param expression: expression (e.g. a-b) or compiled expression (see numpy_tools.ExpressionPlan)
+        """
 
         logging.debug('Starting single_band_calculator... ')
 
-        array_list = [GdalReader().ds2array(gdal_import.src2ds(r))[0] if np.array(r).ndim is 2 else
-                      GdalReader().ds2array(gdal_import.src2ds(r)) for r in rlist]
+        array_list = [gdal_import.src2array(r) for r in rlist]
 
         calculation = tools.array_calculator(array_list, expression)
 
@@ -9,15 +9,86 @@
 # ==========================================================================================
 """ This module is a test"""
 
-import collections
+import ast
 import logging
+import multiprocessing
 import numpy as np
-from scipy import stats as scipy_stats
+from multiprocessing.pool import ThreadPool
+from scipy import ndimage
 
 from core import miscellaneous
+from core.bunch import Config
 
 
-def reclassify(array, new_value, old_value_min=None, old_value_max=None, nodata=0):
+def working_dtype():
+    """ Floating point precision used in the calculations (Config()['working_dtype'], float32 by default)"""
+
+    return np.dtype(Config().get('working_dtype', 'float32'))
+
+
+def categorical(array, nodata=0):
+    """ Compact uint8 array for classified rasters. NaN and values out of the 0-255 range are set as nodata.
+    :param array: array with the classes
+    :param nodata: class for no data values
+    """
+
+    valid = np.isfinite(array)
+    valid[valid] = np.logical_and(array[valid] >= 0, array[valid] <= 255)
+
+    classes = np.empty(array.shape, dtype=np.uint8)
+    classes[...] = nodata
+    np.copyto(classes, array, casting='unsafe', where=valid)
+
+    return classes
+
+
+def classify(array, classes, nodata=None, nodata_class=0):
+    """ Reclassify with a class table in one pass. The output is uint8.
+    :param array: array with the values
+    :param classes: ordered list of ((min, max), value) rules. Limits are inclusive, rounded to 3 decimals
+    (as reclassify) and None is not limited. The first rule matching a value is applied. Value None (or 'nan')
+    is the nodata class.
+    :param nodata: nodata value of the array (NaN is always nodata)
+    :param nodata_class: class for nodata and values not matching any rule
+    """
+
+    array = np.asarray(array)
+    valid = np.ones(array.shape, dtype=bool) if not array.dtype.kind == 'f' else np.isfinite(array)
+
+    if nodata is not None and not np.isnan(nodata):
+        valid &= array != nodata
+
+    out = np.empty(array.shape, dtype=np.uint8)
+    out[...] = nodata_class
+
+    # Reversed order, so the first matching rule is the last written
+    match = np.empty(array.shape, dtype=bool)
+    for (value_min, value_max), value in reversed(classes):
+
+        if value is None or str(value).lower() == 'nan':
+            value = nodata_class
+
+        match[...] = valid
+
+        if value_min is not None:
+            match &= array >= round(float(value_min), 3)
+
+        if value_max is not None:
+            match &= array <= round(float(value_max), 3)
+
+        out[match] = value
+
+    return out
+
+
+def reclassify(array, new_value=None, old_value_min=None, old_value_max=None, nodata=0, classes=None):
+    """ Reclassify values in a range (old_value_min to old_value_max) to the new value. If a class table is
+    defined, all the classes are applied in one pass with uint8 output (see classify).
+    """
+
+    if classes is not None:
+        logging.debug('Reclassify raster values: ' + str(classes))
+        return classify(array, classes, nodata=nodata)
 
     logging.debug('Reclassify raster values: ' + str(old_value_min) + 'to ' + str(new_value))
 
@@ -27,7 +98,7 @@ def reclassify(array, new_value, old_value_min=None, old_value_max=None, nodata=
     if new_value == 'nan':
         new_value = np.nan
 
-    array = array.astype(np.float)
+    array = array.astype(working_dtype())
     nodata = float(nodata)
 
     array[array == nodata] = np.nan
@@ -50,7 +121,8 @@ def reclassify(array, new_value, old_value_min=None, old_value_max=None, nodata=
         old_value_max = round(float(old_value_max), 3)
         old_value_min = round(float(old_value_min), 3)
 
-        return np.where(np.logical_and(array >= old_value_min, array <= old_value_max), new_value, array)
+        return np.where(np.logical_and(array >= old_value_min, array <= old_value_max), new_value,
+                        array).astype(working_dtype(), copy=False)
 
     elif old_value_max == old_value_min:
 
@@ -65,133 +137,408 @@ def reclassify(array, new_value, old_value_min=None, old_value_max=None, nodata=
     return array
 
 
-def array_stats(band_array):
+class HistogramStats(object):
+    """ Mergeable statistics of raster values (count, sum, min, max and fixed bins histogram). They are accumulated
+    block by block with update() and partial results of tiles or processes are combined with merge().
+    Without value range only the count, sum, min and max are accumulated (e.g. first pass to find the range).
+    """
+
+    def __init__(self, value_range=None, bins=1024):
+
+        self.value_range = None if value_range is None else (float(value_range[0]), float(value_range[1]))
+        self.bins = int(bins)
+        self.histogram = None if value_range is None else np.zeros(self.bins, dtype=np.int64)
+
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, array, nodata=None):
+        """ Accumulate the valid values of an array with any number of dimensions (NaN and nodata are excluded)"""
+
+        array = np.asarray(array)
+        valid = np.ones(array.shape, dtype=bool) if not array.dtype.kind == 'f' else np.isfinite(array)
+
+        if nodata is not None and not np.isnan(nodata):
+            valid &= array != nodata
+
+        values = array[valid]
+        if not values.size:
+            return self
+
+        self.count += values.size
+        self.sum += float(values.sum(dtype=np.float64))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        if self.histogram is not None:
+            value_min, value_max = self.value_range
+            scale = self.bins / (value_max - value_min) if value_max > value_min else 0
+
+            # Bin index of each value (values out of the range are counted in the first and last bins)
+            bin_ids = ((values.astype(np.float64) - value_min) * scale).astype(np.intp)
+            np.clip(bin_ids, 0, self.bins - 1, out=bin_ids)
+
+            self.histogram += np.bincount(bin_ids, minlength=self.bins)
+
+        return self
+
+    def merge(self, other):
+        """ Combine with the statistics of other blocks (same value range and bins)"""
+
+        if other.histogram is not None or self.histogram is not None:
+            if not self.value_range == other.value_range or not self.bins == other.bins:
+                raise Exception('Statistics with different histogram bins cannot be merged')
+
+            self.histogram += other.histogram
+
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        return self
+
+    def asdict(self):
+        """ Serializable statistics (see from_dict)"""
+
+        return {'value_range': self.value_range, 'bins': self.bins, 'count': self.count, 'sum': self.sum,
+                'min': self.min, 'max': self.max,
+                'histogram': None if self.histogram is None else self.histogram.tolist()}
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+
+        stats = cls(stats_dict['value_range'], bins=stats_dict['bins'])
+        stats.count = stats_dict['count']
+        stats.sum = stats_dict['sum']
+        stats.min = stats_dict['min']
+        stats.max = stats_dict['max']
+
+        if stats_dict['histogram'] is not None:
+            stats.histogram = np.array(stats_dict['histogram'], dtype=np.int64)
+
+        return stats
+
+    def bin_edges(self):
+
+        return np.linspace(self.value_range[0], self.value_range[1], self.bins + 1)
+
+    def mean(self):
+
+        return self.sum / self.count if self.count else np.nan
+
+    def mode(self):
+        """ Centre of the most populated bin"""
+
+        if self.histogram is None or not self.count:
+            return np.nan
+
+        edges = self.bin_edges()
+        bin_id = int(np.argmax(self.histogram))
+
+        return (edges[bin_id] + edges[bin_id + 1]) / 2
+
+    def percentile(self, q):
+        """ Percentile (0-100) interpolated within the histogram bins. q can be a number or a list."""
+
+        if self.histogram is None or not self.count:
+            return np.nan
 
-    if band_array.ndim <> 2:
-        logging.error('array_stats aborted. Band array does not have 2 dimension')
+        edges = self.bin_edges()
+        cdf = np.cumsum(self.histogram)
+
+        target = np.asarray(q, dtype=np.float64) / 100 * self.count
+        bin_ids = np.clip(np.searchsorted(cdf, target), 0, self.bins - 1)
+
+        previous = np.where(bin_ids > 0, cdf[bin_ids - 1], 0)
+        fraction = (target - previous) / np.maximum(self.histogram[bin_ids], 1)
+
+        values = edges[bin_ids] + np.clip(fraction, 0, 1) * (edges[bin_ids + 1] - edges[bin_ids])
+
+        return np.clip(values, self.min, self.max)
+
+    def stats(self):
+
+        stats = {}
+        stats['max'] = self.max if self.count else np.nan
+        stats['min'] = self.min if self.count else np.nan
+        stats['mean'] = self.mean()
+        stats['mode'] = self.mode()
+        stats['median'] = float(self.percentile(50))
+        stats['count'] = self.count
+
+        return stats
+
+
+def array_stats(band_array, nodata=None, bins=1024):
+    """ Statistics of the valid values of the array (max, min, mean, median and binned mode)
+    :param band_array: array with any number of dimensions
+    :param nodata: nodata value (NaN is always excluded)
+    :param bins: number of histogram bins for the mode and percentiles
+    """
+
+    # Value range of the histogram
+    value_range = HistogramStats().update(band_array, nodata=nodata)
+
+    if not value_range.count:
+        logging.error('array_stats aborted. Band array does not have valid values')
         return
 
-    stats = {}
-    stats['max'] = np.nanmax(band_array)
-    stats['min'] = np.nanmin(band_array)
-    stats['mean'] = np.nanmean(band_array)
-    stats['mode'] = scipy_stats.mode(band_array.flatten(), nan_policy='omit')[0][0]
+    stats = HistogramStats((value_range.min, value_range.max), bins=bins)
+    return stats.update(band_array, nodata=nodata).stats()
 
-    # values_list = band_array.flatten()
-    # ['mode2'] = max(set(values_list), key=values_list.count)
-    return stats
 
+def integer_histogram(band, nodata=None):
+    """ Counts of each value of an uint8/uint16 band (nodata excluded). The index is the value.
+    :param band: 2D array (uint8 or uint16)
+    :param nodata: nodata value
+    """
 
-def equalization(bands_list):
-    """Equalization of a 2D array with finite values
-    :param bands_list List of 2D array"""
+    counts = np.bincount(band.ravel(), minlength=np.iinfo(band.dtype).max + 1)
 
-    d_bands = []
-    for i in xrange(len(bands_list)):
+    if nodata is not None and not np.isnan(nodata) and 0 <= nodata < len(counts):
+        counts[int(nodata)] = 0
 
-        # Replace nan values
-        raster_array = bands_list[i]
+    return counts
 
-        # Equalize histogram
-        image_histogram, bins = np.histogram(raster_array.flatten(), 256, normed=True)
-        cdf = image_histogram.cumsum()  # cumulative distribution function
-        cdf = 255 * cdf / cdf[-1]  # normalize
 
-        # use linear interpolation of cdf to find new pixel values
-        image_equalized = np.interp(raster_array.flatten(), bins[:-1], cdf)
-        array_equalized = image_equalized.reshape(raster_array.shape)
+def equalization_lut(band=None, nodata=None, max_limit=255, counts=None, dtype=None, bins=256):
+    """ Lookup table for the equalization of a band. For uint8/uint16 bands it is an array with the equalized
+    value of each integer value (applied by fancy indexing), otherwise it is a HistogramLUT interpolating the
+    cumulative distribution function. Nodata is excluded from the distribution.
+    :param band: 2D array
+    :param nodata: nodata value
+    :param max_limit: maximum equalized value
+    :param counts: counts of each integer value accumulated for a full scene (see integer_histogram). Optional.
+    :param dtype: data type of the integer band if counts is defined
+    :param bins: number of histogram bins for floating point bands
+    """
 
-        # Replace nan values
-        if not isinstance(array_equalized, (np.ndarray, np.generic)):
-            logging.warning('Failed creating equalization')
-            return
+    dtype = np.dtype(dtype if band is None else band.dtype)
 
-        d_bands.append(array_equalized)
+    if dtype.name in ('uint8', 'uint16'):
+        if counts is None:
+            counts = integer_histogram(band, nodata=nodata)
 
-    return np.array(d_bands)
+        # cumulative distribution function
+        cdf = np.cumsum(counts, dtype=np.float64)
+        lut = np.round(max_limit * cdf / max(cdf[-1], 1)).astype(dtype)
 
+        if nodata is not None and not np.isnan(nodata) and 0 <= nodata < len(lut):
+            lut[int(nodata)] = nodata
 
-def normalisation(bands_list, nodata=0, max_limit=255):
-    """Normalisation of a 2D array to 0-255 
-    :param bands_list List of 2D array"""
+        return lut
 
-    d_bands = []
-    for i in xrange(len(bands_list)):
+    valid = np.isfinite(band)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= band != nodata
 
-        if bands_list.ndim == 2:
-            raster_array = bands_list
+    image_histogram, bin_edges = np.histogram(band[valid], bins)
+    cdf = image_histogram.cumsum()  # cumulative distribution function
+    cdf = max_limit * cdf / float(max(cdf[-1], 1))  # normalize
 
-        elif bands_list.ndim > 2:
-            raster_array = bands_list[i]
+    return HistogramLUT(bin_edges[:-1], cdf)
 
-        else:
-            logging.error('Normalisation aborted. Raster array has less than 2 dimension')
-            return
 
-        # raster_array[raster_array == nodata] = np.nan
-        raster_array[np.isnan(raster_array)] = nodata
+def equalization(bands_list, nodata=None, luts=None, workers=None):
+    """Equalization of the bands. uint8/uint16 bands are equalized in their data type with an integer lookup
+    table, other bands are interpolated in the working precision. The bands are processed concurrently.
+    :param bands_list List of 2D array
+    :param nodata: nodata value (excluded from the distribution and not modified)
+    :param luts: list with the lookup table of each band (see equalization_lut) to use the same equalization
+    for all the tiles of a scene. Optional.
+    :param workers: number of threads (one for each band by default)
+    """
+
+    if np.ndim(bands_list) == 2:
+        bands_list = [bands_list]
 
-        raster_array = raster_array.astype(np.float16)
+    def equalize(band_id):
+        raster_array = bands_list[band_id]
 
-        np.seterr(divide='ignore', invalid='ignore')
-        raster_array *= float(max_limit) / raster_array.max()
-        # raster_array = np.divide(raster_array, (raster_array.max()/255))
+        lut = luts[band_id] if luts else equalization_lut(raster_array, nodata=nodata)
 
-        # mask = np.ma.masked_invalid(raster_array)
-        raster_array = np.ma.masked_invalid(raster_array).filled(nodata)
-        raster_array = raster_array.astype(np.uint8)
+        if isinstance(lut, HistogramLUT):
+            return lut.apply(raster_array, nodata=nodata)
 
-        if not isinstance(raster_array, (np.ndarray, np.generic)):
-            logging.warning('Failed creating equalization')
-            return
+        return lut[raster_array]
+
+    workers = len(bands_list) if workers is None else max(1, int(workers))
+
+    if workers > 1:
+        pool = ThreadPool(min(workers, len(bands_list)))
 
-        d_bands.append(raster_array)
+        try:
+            d_bands = pool.map(equalize, xrange(len(bands_list)))
+
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        d_bands = [equalize(band_id) for band_id in xrange(len(bands_list))]
 
     return np.array(d_bands)
 
 
-def histogram_matching(array1, array2, nodata=0):
+def percentile_stretch(array, limits, nodata=0, max_limit=255, dtype=np.uint8, out=None, out_nodata=None):
+    """ Linear stretch of the values between the limits to 0-max_limit (values out of the limits are clipped).
+    NaN and nodata values are set as output nodata.
+    :param array: array with any number of dimensions
+    :param limits: (low, high) values, e.g. percentiles of the band (see HistogramStats.percentile)
+    :param nodata: nodata value of the input array
+    :param max_limit: maximum output value
+    :param dtype: output data type
+    :param out: output array (optional). It can be the input array to stretch it in place.
+    :param out_nodata: nodata value of the output (nodata if not defined)
+    """
+
+    if out_nodata is None:
+        out_nodata = 0 if nodata is None else nodata
+
+    low, high = float(limits[0]), float(limits[1])
+    scale = float(max_limit) / (high - low) if high > low else 0
+
+    valid = np.isfinite(array) if array.dtype.kind == 'f' else np.ones(array.shape, dtype=bool)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= array != nodata
+
+    stretched = np.subtract(array, low, dtype=working_dtype())
+    stretched *= scale
+    np.clip(stretched, 0, max_limit, out=stretched)
+
+    if out is None:
+        out = np.empty(array.shape, dtype=dtype)
+
+    if out.dtype.kind in 'ui':
+        np.rint(stretched, out=stretched)
+
+    np.copyto(out, stretched, casting='unsafe')
+    out[~valid] = out_nodata
+
+    return out
+
+
+def band_limits(band, percentiles=None, nodata=0, bins=1024):
+    """ Stretch limits of the band: the percentiles of the valid values (see HistogramStats) or 0 and the maximum
+    value if the percentiles are not defined.
+    """
+
+    value_range = HistogramStats().update(band, nodata=nodata)
+
+    if not value_range.count:
+        return 0, 0
+
+    if percentiles is None:
+        return 0, value_range.max
+
+    stats = HistogramStats((value_range.min, value_range.max), bins=bins).update(band, nodata=nodata)
+    return tuple(stats.percentile(percentiles))
+
+
+def normalisation(bands_list, nodata=0, max_limit=255, percentiles=None, limits=None, dtype=np.uint8,
+                  out_nodata=None):
+    """Normalisation of the bands to 0-255 (uint8 by default)
+    :param bands_list List of 2D array (or a 2D array)
+    :param nodata: nodata value of the input bands
+    :param max_limit: maximum output value
+    :param percentiles: (low, high) percentiles stretched to 0 and max_limit. The values are divided by the maximum
+    if they are not defined.
+    :param limits: list with the (low, high) values of each band (e.g. computed for the full scene, see
+    band_limits). Optional.
+    :param dtype: output data type
+    :param out_nodata: nodata value of the output (nodata if not defined)
+    """
+
+    if np.ndim(bands_list) < 2:
+        logging.error('Normalisation aborted. Raster array has less than 2 dimension')
+        return
+
+    if np.ndim(bands_list) == 2:
+        bands_list = [bands_list]
+
+    # Note that the input array is not modified (it can be shared with a dataset)
+    d_bands = np.empty((len(bands_list),) + np.shape(bands_list[0]), dtype=dtype)
+
+    for i in xrange(len(bands_list)):
+        raster_array = bands_list[i]
+
+        limits_i = limits[i] if limits else band_limits(raster_array, percentiles=percentiles, nodata=nodata)
+        percentile_stretch(raster_array, limits_i, nodata=nodata, max_limit=max_limit, out=d_bands[i],
+                           out_nodata=out_nodata)
+
+    return d_bands
+
 
-    # Histogram matching
-    oldshape = array2.shape
-    source = array2.ravel()
-    template = array1.ravel()
+class HistogramLUT(object):
+    """ Lookup table mapping the values of a source raster to the distribution of a template raster (histogram
+    matching). It is fitted from the histograms of both rasters (see HistogramStats), so it can be fitted from
+    streaming statistics and applied block by block.
+    """
+
+    def __init__(self, source_values, target_values):
+
+        self.source_values = np.asarray(source_values, dtype=np.float64)
+        self.target_values = np.asarray(target_values, dtype=np.float64)
+
+    @classmethod
+    def from_stats(cls, source_stats, template_stats):
+        """ Fit the table from the histograms of the source and the template
+        :param source_stats: HistogramStats of the source values
+        :param template_stats: HistogramStats of the template values
+        """
 
-    # get the set of unique pixel values and their corresponding indices and counts
+        # Quantile of each bin edge of the source (empirical cumulative distribution function)
+        quantiles = np.concatenate(([0], np.cumsum(source_stats.histogram))) / float(max(source_stats.count, 1))
 
-    # isuse with numpy version
-    # s_values, bin_idx, s_counts = np.unique(source, return_inverse=True, return_counts=True)
+        # Template values with the same quantiles
+        target_values = template_stats.percentile(quantiles * 100)
 
-    s_values, bin_idx = np.unique(source, return_inverse=True)
-    s_counts = collections.Counter(source).values()
+        return cls(source_stats.bin_edges(), target_values)
 
-    # slower option
-    # s_values =  sorted(set(source))
-    # s_counts = [list(source.flatten()).count(v) for v in s_values]
+    def apply(self, array, nodata=None, dtype=None):
+        """ Map the values of the array (NaN and nodata are not modified)
+        :param array: array with any number of dimensions
+        :param nodata: nodata value
+        :param dtype: output data type (working data type by default)
+        """
 
-    # isuse with numpy version
-    # t_values, t_counts = np.unique(template, return_counts=True)
+        dtype = working_dtype() if dtype is None else np.dtype(dtype)
 
-    t_values = np.unique(template)
-    t_counts = collections.Counter(template).values()
+        valid = np.isfinite(array) if array.dtype.kind == 'f' else np.ones(array.shape, dtype=bool)
 
-    # slower option
-    # t_values =  sorted(set(template))
-    # t_counts = [list(template.flatten()).count(v) for v in t_values]
+        if nodata is not None and not np.isnan(nodata):
+            valid &= array != nodata
 
-    # take the cumsum of the counts and normalize by the number of pixels to
-    # get the empirical cumulative distribution functions for the source and
-    # template images (maps pixel value --> quantile)
-    s_quantiles = np.cumsum(s_counts).astype(np.float64)
-    s_quantiles /= s_quantiles[-1]
-    t_quantiles = np.cumsum(t_counts).astype(np.float64)
-    t_quantiles /= t_quantiles[-1]
+        matched = np.empty(array.shape, dtype=dtype)
+        matched[~valid] = array[~valid]
+        matched[valid] = np.interp(array[valid], self.source_values, self.target_values)
+
+        return matched
+
+
+def histogram_matching(array, reference, nodata=0, bins=1024):
+    """ Match the histogram of the array to the histogram of the reference. Nodata values are excluded.
+    :param array: array to be modified
+    :param reference: array with the reference distribution
+    :param nodata: nodata value of both arrays
+    :param bins: number of histogram bins
+    """
 
-    # interpolate linearly to find the pixel values in the template image
-    # that correspond most closely to the quantiles in the source image
-    interp_t_values = np.interp(s_quantiles, t_quantiles, t_values)
+    def histogram(values):
+        value_range = HistogramStats().update(values, nodata=nodata)
+        return HistogramStats((value_range.min, value_range.max), bins=bins).update(values, nodata=nodata)
 
-    return np.ma.masked_invalid(interp_t_values[bin_idx].reshape(oldshape)).filled(nodata)
+    source_stats = histogram(array)
+    reference_stats = histogram(reference)
+
+    if not source_stats.count or not reference_stats.count:
+        logging.warning('Histogram matching aborted. Arrays do not have valid values')
+        return array.astype(working_dtype())
+
+    return HistogramLUT.from_stats(source_stats, reference_stats).apply(array, nodata=nodata)
 
 
 def rgb_intensity(bands_list):
@@ -204,7 +551,10 @@ def rgb_intensity(bands_list):
         return
 
     else:
-        intensity = (0.3 * bands_list[2] + 0.59 * bands_list[1] + 0.11 * bands_list[0])
+        dtype = working_dtype()
+        intensity = np.multiply(bands_list[2], 0.3, dtype=dtype)
+        intensity += np.multiply(bands_list[1], 0.59, dtype=dtype)
+        intensity += np.multiply(bands_list[0], 0.11, dtype=dtype)
         return intensity
 
 
@@ -215,20 +565,211 @@ def vegetation_index(red, green, nir=None):
     :param nir band array (optional)
     """
 
+    dtype = working_dtype()
+
     if nir is None:
         # GRVI = (Green - Red) / (Green + Red) "
-        vi = np.divide(np.array(green, dtype="float32") - np.array(red, dtype="float32"),
-                       np.array((green + red), dtype="float32"))
+        vi = np.divide(np.array(green, dtype=dtype) - np.array(red, dtype=dtype),
+                       np.array((green + red), dtype=dtype))
 
     else:
         # NDVI = (NIR - Red) / (NIR + Red) "
-        vi = np.divide(np.array(nir, dtype="float32") - np.array(red, dtype="float32"),
-                       np.array((nir + red), dtype="float32"))
+        vi = np.divide(np.array(nir, dtype=dtype) - np.array(red, dtype=dtype),
+                       np.array((nir + red), dtype=dtype))
 
     return vi
 
 
-def zonal_stats(valuesarr, zonesarr, count=True, mean=True, stdev=True, resize=True, nodata=0):
+def change_kernel(bands1, bands2, method='ndvi', out=None, chunk_rows=256):
+    """ Difference of the change index between two dates (index 1 - index 2) in one pass. Only the output is
+    allocated with the full size, the intermediate values are computed in buffers of chunk_rows rows.
+    :param bands1: sequence of 2D arrays with the bands of the first date
+    :param bands2: sequence of 2D arrays with the bands of the second date
+    :param method: 'ndvi' ([RED, NIR] or [RED, GREEN] for GRVI), 'intensity' ([RED, GREEN, BLUE]) or 'nir' ([NIR])
+    :param out: output array (optional)
+    :param chunk_rows: number of rows of the intermediate buffers
+    """
+
+    method = method.lower()
+    dtype = working_dtype()
+
+    if method not in ('ndvi', 'grvi', 'intensity', 'nir'):
+        raise Exception("Change detection method not defined")
+
+    rows, cols = bands1[0].shape
+
+    if out is None:
+        out = np.empty((rows, cols), dtype=dtype)
+
+    chunk_rows = max(1, min(int(chunk_rows), rows))
+    index_buffer = np.empty((chunk_rows, cols), dtype=dtype)
+    tmp_buffer = np.empty((chunk_rows, cols), dtype=dtype)
+
+    def change_index(bands, rslice, result, tmp):
+
+        if method in ('ndvi', 'grvi'):
+            # (NIR - Red) / (NIR + Red) or (Green - Red) / (Green + Red)
+            np.subtract(bands[1][rslice], bands[0][rslice], out=result, dtype=dtype)
+            np.add(bands[1][rslice], bands[0][rslice], out=tmp, dtype=dtype)
+            np.divide(result, tmp, out=result)
+
+        elif method == 'intensity':
+            np.multiply(bands[2][rslice], 0.3, out=result, dtype=dtype)
+            result += np.multiply(bands[1][rslice], 0.59, out=tmp, dtype=dtype)
+            result += np.multiply(bands[0][rslice], 0.11, out=tmp, dtype=dtype)
+
+        else:
+            result[...] = bands[0][rslice]
+
+        return result
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for row in xrange(0, rows, chunk_rows):
+            rslice = slice(row, min(row + chunk_rows, rows))
+            nrows = rslice.stop - rslice.start
+
+            change_index(bands1, rslice, out[rslice], tmp_buffer[:nrows])
+            out[rslice] -= change_index(bands2, rslice, index_buffer[:nrows], tmp_buffer[:nrows])
+
+    return out
+
+
+class ZonalAccumulator(object):
+    """ Mergeable statistics by zone (count, sum, sum of squares, min and max). They are accumulated from aligned
+    blocks of values and zones with update() and partial results of tiles or processes are combined with merge().
+    Negative zone IDs are not zones. Zones without valid values have count 0.
+    """
+
+    stats_names = ('count', 'sum', 'sumsq', 'min', 'max')
+
+    def __init__(self):
+
+        self.zones = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+        self.sum = np.empty(0, dtype=np.float64)
+        self.sumsq = np.empty(0, dtype=np.float64)
+        self.min = np.empty(0, dtype=np.float64)
+        self.max = np.empty(0, dtype=np.float64)
+
+    def update(self, values, zones, nodata=None):
+        """ Accumulate a block of values (NaN and nodata are excluded) and the zones of the same shape"""
+
+        in_zone = zones >= 0
+
+        # Zone index of each pixel in the block
+        block = ZonalAccumulator()
+        block.zones, zone_index = np.unique(zones[in_zone].astype(np.int64), return_inverse=True)
+
+        values = values[in_zone]
+        valid = np.isfinite(values) if values.dtype.kind == 'f' else np.ones(values.shape, dtype=bool)
+
+        if nodata is not None and not np.isnan(nodata):
+            valid &= values != nodata
+
+        zone_index = zone_index[valid]
+        values = values[valid].astype(np.float64)
+        nzones = len(block.zones)
+
+        block.count = np.bincount(zone_index, minlength=nzones)
+        block.sum = np.bincount(zone_index, weights=values, minlength=nzones)
+        block.sumsq = np.bincount(zone_index, weights=values ** 2, minlength=nzones)
+
+        # Min and max of the sorted values of each zone
+        block.min = np.empty(nzones, dtype=np.float64)
+        block.max = np.empty(nzones, dtype=np.float64)
+        block.min[...] = np.inf
+        block.max[...] = -np.inf
+
+        if values.size:
+            order = np.argsort(zone_index, kind='mergesort')
+            sorted_values = values[order]
+            zones_found = block.count > 0
+            starts = np.searchsorted(zone_index[order], np.flatnonzero(zones_found))
+
+            block.min[zones_found] = np.minimum.reduceat(sorted_values, starts)
+            block.max[zones_found] = np.maximum.reduceat(sorted_values, starts)
+
+        return self.merge(block)
+
+    def merge(self, other):
+        """ Combine with the statistics of other blocks"""
+
+        if not len(other.zones):
+            return self
+
+        if not len(self.zones):
+            for name in ('zones',) + self.stats_names:
+                setattr(self, name, getattr(other, name).copy())
+
+            return self
+
+        zones = np.union1d(self.zones, other.zones)
+        self_index = np.searchsorted(zones, self.zones)
+        other_index = np.searchsorted(zones, other.zones)
+
+        for name in self.stats_names:
+            stat = np.empty(len(zones), dtype=getattr(self, name).dtype)
+            stat[...] = {'min': np.inf, 'max': -np.inf}.get(name, 0)
+
+            for index, partial in ((self_index, self), (other_index, other)):
+                if name == 'min':
+                    stat[index] = np.minimum(stat[index], partial.min)
+
+                elif name == 'max':
+                    stat[index] = np.maximum(stat[index], partial.max)
+
+                else:
+                    stat[index] += getattr(partial, name)
+
+            setattr(self, name, stat)
+
+        self.zones = zones
+        return self
+
+    def table(self):
+        """ Statistics by zone (count, sum, mean, stdev, min and max). NaN for zones without valid values."""
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sum / self.count
+            stdev = np.sqrt(np.maximum(self.sumsq / self.count - mean ** 2, 0))
+
+        found = self.count > 0
+
+        return {'zone': self.zones, 'count': self.count, 'sum': self.sum, 'mean': mean, 'stdev': stdev,
+                'min': np.where(found, self.min, np.nan), 'max': np.where(found, self.max, np.nan)}
+
+    def broadcast(self, zones, stat='mean', nodata=0, table=None):
+        """ Raster with the statistic of the zone of each pixel (nodata out of the zones)
+        :param zones: array (or block) with the zone IDs
+        :param stat: name of the statistic in the table
+        :param nodata: value out of the zones
+        :param table: statistics by zone (see table) to avoid computing them for each block
+        """
+
+        if table is None:
+            table = self.table()
+
+        zone_index = np.searchsorted(self.zones, zones)
+        in_zone = zones >= 0
+        in_zone[in_zone] = zone_index[in_zone] < len(self.zones)
+        in_zone[in_zone] = self.zones[zone_index[in_zone]] == zones[in_zone]
+
+        raster = np.empty(zones.shape, dtype=working_dtype())
+        raster[...] = nodata
+        raster[in_zone] = table[stat][zone_index[in_zone]]
+
+        return raster
+
+
+def zonal_stats(valuesarr, zonesarr, count=True, mean=True, stdev=True, resize=True, nodata=0, values_nodata=None):
+    """ Statistics of the values for each zone (count, mean and standard deviation) computed in one pass.
+    It returns the rasters with the statistics of each pixel zone and the table of statistics by zone ('table').
+    :param valuesarr: 2D array with the values
+    :param zonesarr: 2D array with the zone IDs. Negative IDs are not zones.
+    :param resize: Boolean. Use the common area if the shapes do not match
+    :param nodata: value of the output rasters outside the zones
+    :param values_nodata: nodata value of the values (NaN is always excluded)
+    """
 
     # Get dimension
     rows = valuesarr.shape[0]
@@ -240,91 +781,221 @@ def zonal_stats(valuesarr, zonesarr, count=True, mean=True, stdev=True, resize=T
             cols = min(valuesarr.shape[1], zonesarr.shape[1])
 
         else:
-            logging.error("Zonal Statistics", "Error raster shape does not match: vaulues shape=" +
-                          str(valuesarr.shape) + ", zones shape=" + str(zonesarr.shape[1]))
+            logging.error("Zonal Statistics. Error raster shape does not match: vaulues shape=" +
+                          str(valuesarr.shape) + ", zones shape=" + str(zonesarr.shape))
             return
 
     # Data format
     valuesarr = valuesarr[:rows, :cols]
     zonesarr = zonesarr[:rows, :cols]
-    zoneslist = zonesarr.ravel()
 
-    # stats
-    # Create a dictionary with the object ID as key, and the
-    # locations of each pixel in zonal raster that has the same ID (1D array)
-    objects = collections.defaultdict(list)
-    [objects[zonesarr[i, j]].append([i, j]) for i, j in np.ndindex(zonesarr.shape)]
+    accumulator = ZonalAccumulator().update(valuesarr, zonesarr, nodata=values_nodata)
+    table = accumulator.table()
 
-    outputs = {}
-    # Now, calculate the mean raster value per zonal dic "label" (table stats)
-    if count:
-        countdict = dict(zip(objects.keys(), [
-            len([valuesarr[i, j] for i, j in objects[k] if not valuesarr[i, j] == np.nan]) if k >= 0 else nodata for
-            k in objects.keys()]))
+    outputs = {'table': table}
+    for stat, required in (('count', count), ('mean', mean), ('stdev', stdev)):
+        if required:
+            outputs[stat] = accumulator.broadcast(zonesarr, stat=stat, nodata=nodata, table=table)
 
-        # Assign the values for each objects
-        countarr = map(countdict.get, zoneslist)
-        countarr = np.array(np.reshape(countarr, (rows, cols)), dtype="float32")
+    return outputs
 
-        # Create raster
-        outputs['count'] = countarr
 
-    if mean:
-        meandic = dict(zip(objects.keys(), [
-            np.mean([valuesarr[i, j] for i, j in objects[k] if not valuesarr[i, j] == np.nan]) if k >= 0 else nodata
-            for k in objects.keys()]))
+def seam_mask(array, nodata=None):
+    """ Pixels on the edges of the valid data (including the edges of the array), where the seams between
+    tiles are found. For 3D arrays a pixel is valid if it is valid in all the bands.
+    :param array: 2D or 3D (bands, rows, cols) array
+    :param nodata: Nodata value (NaN is always invalid)
+    """
 
-        # Assign the values for each objects
-        meanarr = map(meandic.get, zoneslist)
-        meanarr = np.array(np.reshape(meanarr, (rows, cols)), dtype="float32")
+    valid = np.ones(array.shape, dtype=bool) if not array.dtype.kind == 'f' else np.isfinite(array)
 
-        # Create raster
-        outputs['mean'] = meanarr
+    if nodata is not None and not np.isnan(nodata):
+        valid &= array != nodata
 
-    if stdev:
-        stdndic = dict(zip(objects.keys(), [
-            np.std([valuesarr[i, j] for i, j in objects[k] if not valuesarr[i, j] == np.nan]) if k >= 0 else nodata
-            for k in objects.keys()]))
+    if valid.ndim == 3:
+        valid = valid.all(axis=0)
 
-        # Assign the values for each objects
-        stdarr = map(stdndic.get, zoneslist)
-        stdarr = np.array(np.reshape(stdarr, (rows, cols)), dtype="float32")
+    return valid & ~ndimage.binary_erosion(valid, border_value=0)
 
-        # Create raster
-        outputs['stdev'] = stdarr
 
-    del zonesarr
-    del valuesarr
+def seam_blend(array, seams, width=1, nodata=None):
+    """ Blend the seams between tiles. The pixels near the seams are replaced by the mean of the valid pixels in
+    their (2 * width + 1) neighbourhood (NaN and nodata are ignored), so the smoothing always crosses the seam.
+    With width > 1 the blending is feathered: the weight of the smoothed values decreases linearly with the
+    distance to the seam.
+    :param array: 2D or 3D (bands, rows, cols) array
+    :param seams: 2D boolean array with the seam pixels (see seam_mask)
+    :param width: Feathering width in pixels
+    :param nodata: Nodata value (NaN is always ignored)
+    """
 
-    return outputs
+    if array.ndim == 3:
+        return np.array([seam_blend(band, seams, width=width, nodata=nodata) for band in array])
+
+    dtype = working_dtype()
+
+    valid = np.ones(array.shape, dtype=bool) if not array.dtype.kind == 'f' else np.isfinite(array)
+
+    if nodata is not None and not np.isnan(nodata):
+        valid &= array != nodata
 
+    # NaN-aware mean: sum of the valid values divided by the number of valid pixels
+    size = 2 * max(1, int(width)) + 1
+    values_sum = ndimage.uniform_filter(np.where(valid, array, 0).astype(dtype), size=size, mode='constant')
+    valid_sum = ndimage.uniform_filter(valid.astype(dtype), size=size, mode='constant')
 
-def array_calculator(array_list, expression):
-    """ Raster calculator 
-        :param expression: use letters for each array by order in the list (e.g.a*2+b)
-        :param array_list List of 2D array"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        smoothed = values_sum / valid_sum
 
-    logging.info('Initializing _raster calculator...')
-    logging.info(expression)
+    # Blending weight
+    if width > 1:
+        weight = 1 - ndimage.distance_transform_edt(~seams).astype(dtype) / width
+        np.clip(weight, 0, 1, out=weight)
+
+    else:
+        weight = seams.astype(dtype)
+
+    weight[~valid | ~(valid_sum > 0)] = 0
+
+    blended = array.astype(dtype) * (1 - weight) + smoothed * weight
+    blended = np.where(weight > 0, blended, array)
+
+    if not array.dtype.kind == 'f':
+        blended = np.round(blended)
+
+    return blended.astype(array.dtype)
+
+
+class ExpressionPlan(object):
+    """ Raster calculator expression parsed, validated and compiled once. Letters are the arrays by order in the
+    list (e.g. a*2+b) and only arithmetic, comparisons and the numpy functions in 'functions' are allowed.
+    The plan has no state, so it can be evaluated concurrently from several threads.
+    """
 
     alphabet = tuple('abcdefghijklmnopqrstuvwxyz')
-    # rasterdic = defaultdict(list)
 
-    i = 0
-    for array in array_list:
-        globals()[alphabet[i]] = array
-        i += 1
-    # setattr(self, str(alphabet[i]),np.array(gdalr.raster2array(_raster, band=1),dtype='float'))
-    # expression = expression.replace(alphabet[i],'self.' + alphabet[i])
+    functions = {'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+                 'minimum': np.minimum, 'maximum': np.maximum, 'where': np.where, 'isnan': np.isnan,
+                 'nan_to_num': np.nan_to_num}
+
+    def __init__(self, expression):
+
+        self.expression = expression
+
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+
+        except SyntaxError:
+            raise Exception('Raster calculator expression not valid: ' + str(expression))
+
+        names = set()
+        for node in ast.walk(tree):
+
+            if isinstance(node, ast.Name):
+                if node.id not in self.alphabet and node.id not in self.functions:
+                    raise Exception('Raster calculator variable not defined: ' + str(node.id))
+
+                if node.id in self.alphabet:
+                    names.add(node.id)
+
+            elif isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in self.functions:
+                    raise Exception('Raster calculator function not supported: ' + str(expression))
+
+            elif not isinstance(node, self._allowed_nodes()):
+                raise Exception('Raster calculator operation not supported: ' + type(node).__name__)
+
+        if not names:
+            raise Exception('Raster calculator expression without rasters: ' + str(expression))
+
+        self.variables = tuple(sorted(names))
+        self.code = compile(tree, '<raster calculator>', 'eval')
+
+    def __str__(self):
+        return self.expression
+
+    @staticmethod
+    def _allowed_nodes():
+
+        names = ('Expression', 'BinOp', 'UnaryOp', 'Compare', 'Num', 'Constant', 'operator', 'unaryop', 'cmpop',
+                 'expr_context')
+
+        return tuple(getattr(ast, name) for name in names if hasattr(ast, name))
+
+    def _evaluate(self, array_list, rslice=Ellipsis):
+        """ Evaluate the expression for the rows of the slice (all the array if not defined)"""
+
+        namespace = dict(self.functions)
+        for name in self.variables:
+            array = array_list[self.alphabet.index(name)]
+            namespace[name] = array[..., rslice, :] if np.ndim(array) >= 2 else array
+
+        return eval(self.code, {'__builtins__': {}}, namespace)
+
+    def evaluate(self, array_list, chunk_rows=None, workers=None):
+        """ Evaluate the expression chunk by chunk (temporary arrays are bounded by the chunk size). The chunks are
+        written in the output as they are completed.
+        :param array_list: list of 2D (or 3D) arrays with the same number of rows and columns
+        :param chunk_rows: number of rows for each chunk (Config()['chunk_shape'] or 256 rows by default)
+        :param workers: number of threads (Config()['calculator_threads'] or the number of CPUs by default)
+        """
+
+        if len(array_list) < self.alphabet.index(self.variables[-1]) + 1:
+            raise Exception('Not enough rasters for the expression: ' + str(self.expression))
+
+        rows = max(np.shape(array_list[self.alphabet.index(name)])[-2] for name in self.variables)
+
+        if chunk_rows is None:
+            chunk_rows = (Config().get('chunk_shape') or (256, 256))[0]
+
+        if workers is None:
+            workers = Config().get('calculator_threads', multiprocessing.cpu_count())
+
+        chunk_rows = max(1, min(int(chunk_rows), rows))
+        slices = [slice(row, min(row + chunk_rows, rows)) for row in xrange(0, rows, chunk_rows)]
+
+        # The first chunk defines the data type of the output
+        first = np.asarray(self._evaluate(array_list, slices[0]))
+        out = np.empty(first.shape[:-2] + (rows,) + first.shape[-1:], dtype=first.dtype)
+        out[..., slices[0], :] = first
+        del first
+
+        def evaluate_chunk(rslice):
+            out[..., rslice, :] = self._evaluate(array_list, rslice)
+
+        workers = max(1, min(int(workers), len(slices) - 1))
+
+        if workers > 1:
+            pool = ThreadPool(workers)
+
+            try:
+                pool.map(evaluate_chunk, slices[1:])
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            for rslice in slices[1:]:
+                evaluate_chunk(rslice)
+
+        return out
+
 
-    # rasterdic[alphabet[i]].append(np.array(gdalr.raster2array(_raster, band=1),dtype='float'))
-    # expression = expression.replace(alphabet[i],'rasterdic[' + alphabet[i] + ']')
+def array_calculator(array_list, expression, chunk_rows=None, workers=None):
+    """ Raster calculator
+        :param expression: use letters for each array by order in the list (e.g.a*2+b) or a compiled
+        ExpressionPlan
+        :param array_list List of 2D array
+        :param chunk_rows: number of rows evaluated at once
+        :param workers: number of threads"""
 
-    global gexpression
-    gexpression = expression
+    if not isinstance(expression, ExpressionPlan):
+        logging.info('Initializing _raster calculator...')
+        logging.info(expression)
 
-    outarr = eval(gexpression)
+        expression = ExpressionPlan(expression)
 
-    return outarr
+    return expression.evaluate(array_list, chunk_rows=chunk_rows, workers=workers)
 
 
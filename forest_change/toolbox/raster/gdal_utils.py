@@ -20,7 +20,10 @@ except ImportError:
 
 import logging
 import math
+import multiprocessing
 import numpy as np
+import os
+from multiprocessing.pool import ThreadPool
 
 from spatial import gdal_import, ogr_import
 from spatial import gdal_reader as gdalr
@@ -28,6 +31,9 @@ from spatial.gdal_reader import GdalReader
 from toolbox.vector import ogr_utils
 
 from spatial import ogr_reader as ogrr
+from toolbox import numpy_tools
+from core import miscellaneous
+from core.bunch import Config
 
 try:
     from osgeo import gdal, ogr, gdal_array
@@ -43,8 +49,64 @@ except ImportError:
 # from gdalconst import *
 
 
-def single_bands_to_multiband(gdal_bands_list, output=None):
-    """ Convert several gdal single file to a single gdal datasource"""
+def _band_path(band_dataset):
+    """ File path of a gdal source (None for in-memory datasets)"""
+
+    if isinstance(band_dataset, basestring):
+        return band_dataset
+
+    file_path = band_dataset.GetDescription()
+    if file_path and os.path.isfile(file_path):
+        return file_path
+
+
+def _decode_band(band_job):
+    """ Decode the first band of a file. Each thread opens its own handle (gdal handles are not thread-safe).
+    The threads of the gdal decoder are set only for the current thread."""
+
+    band_id, band_path, decoder_threads = band_job
+    with gdalr.config_option('GDAL_NUM_THREADS', str(decoder_threads), thread_local=True):
+        band_ds = gdal.Open(band_path, gdal.GA_ReadOnly)
+        array_i = band_ds.GetRasterBand(1).ReadAsArray()
+        band_ds = None
+
+    return band_id, array_i
+
+
+def bands_to_vrt(band_paths, output=None):
+    """ Stack single band files as a VRT (virtual dataset referencing the original files, no data copied).
+    The VRT is saved in the tempdir."""
+
+    if not output:
+        output = 'image_multiband'
+
+    tempdir = Config()['tempdir']
+    if not os.path.exists(tempdir):
+        os.makedirs(tempdir)
+
+    vrt_path = miscellaneous.new_unique_file(
+        os.path.join(tempdir, os.path.splitext(os.path.basename(output))[0] + '.vrt'))
+
+    vrt_ds = gdal.BuildVRT(vrt_path, band_paths, separate=True)
+    vrt_ds.SetMetadataItem('FilePath', vrt_path)
+    vrt_ds.FlushCache()
+
+    return vrt_ds
+
+
+def single_bands_to_multiband(gdal_bands_list, output=None, virtual=False):
+    """ Convert several gdal single file to a single gdal datasource. The files are decoded concurrently
+    (Config()['decode_workers'] threads, one per band by default) and each band is written in the output as
+    soon as it is decoded. Config()['decoder_threads'] sets the threads of the gdal decoder for each band.
+    :param virtual: Boolean. Stack the files as VRT (data is read from the files only when required)"""
+
+    if virtual:
+        band_paths = [_band_path(band_dataset) for band_dataset in gdal_bands_list]
+
+        if all(band_paths) and hasattr(gdal, 'BuildVRT'):
+            return bands_to_vrt(band_paths, output=output)
+
+        logging.warning('Bands cannot be stacked as VRT. Bands are copied to a new dataset.')
 
     # Get mask
     # src_ds = gdal.OpenShared(gdal_bands_list[0])
@@ -63,10 +125,18 @@ def single_bands_to_multiband(gdal_bands_list, output=None):
     out_ds.SetProjection(src_ds.GetProjection())
     out_ds.SetGeoTransform(src_ds.GetGeoTransform())
 
+    # Files are decoded in parallel. In-memory datasets are read directly.
+    band_jobs = []
     i = 0
     for band_dataset in gdal_bands_list:
 
         i = i + 1
+        band_path = _band_path(band_dataset)
+
+        if band_path:
+            band_jobs.append((i, band_path))
+            continue
+
         band_ds = GdalReader().gdal2ds(band_dataset)
         # mask_ds = gdal.OpenShared(band_dataset)
         array_i = band_ds.GetRasterBand(1).ReadAsArray()
@@ -75,6 +145,25 @@ def single_bands_to_multiband(gdal_bands_list, output=None):
         band_ds = None
         del array_i
 
+    if band_jobs:
+        workers = max(1, min(int(Config().get('decode_workers', len(band_jobs))), len(band_jobs)))
+        decoder_threads = Config().get('decoder_threads', max(1, multiprocessing.cpu_count() // workers))
+        band_jobs = [(band_id, band_path, decoder_threads) for band_id, band_path in band_jobs]
+
+        logging.debug('Decoding ' + str(len(band_jobs)) + ' bands with ' + str(workers) + ' workers and ' +
+                      str(decoder_threads) + ' decoder threads')
+
+        # GDAL releases the GIL while decoding
+        pool = ThreadPool(workers)
+        try:
+            for band_id, array_i in pool.imap_unordered(_decode_band, band_jobs):
+                out_ds.GetRasterBand(band_id).WriteArray(array_i)
+                del array_i
+
+        finally:
+            pool.close()
+            pool.join()
+
     if GdalReader().isvalid(out_ds):
         return out_ds
 
@@ -90,92 +179,251 @@ def single_bands_to_multiband(gdal_bands_list, output=None):
         #     return
 
 
-def merge(src_ds_list, outname, smooth_edges=False):
-    # First layer metadata
-    src_ds = GdalReader().gdal2ds(src_ds_list[0])
-    src_ds_list = [GdalReader().gdal2ds(r) for r in src_ds_list]
-    geotransform = src_ds.GetGeoTransform()
-    xres = geotransform[1]
-    yres = geotransform[5]
-    projection = src_ds.GetProjection()
-    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+class TileMosaic(object):
+    """ Output raster of a merge created up front. Each tile is written in its window as soon as it is added,
+    so only one tile is kept in memory. The output is created when the first tile is added (data type and number
+    of bands of the tiles) and the pixels not covered by any tile are nodata.
 
-    # Get common extent
-    xmin, xmax, ymin, ymax = GdalReader().get_extent(src_ds)
+    If smooth_edges is True, the edges of the tiles are recorded in a boolean mask and they are blended when the
+    mosaic is closed (see numpy_tools.seam_blend). feather is the blending width in pixels.
+    """
 
-    bands = src_ds.RasterCount
+    def __init__(self, outname, geotransform, projection, xsize, ysize, nodata=None, smooth_edges=False,
+                 feather=1):
 
-    for src_i in src_ds_list:
+        self.outname = outname
+        self.geotransform = list(geotransform)
+        self.projection = projection
+        self.xsize = xsize
+        self.ysize = ysize
+        self.nodata = nodata
+        self.out_ds = None
 
-        xmin_i, xmax_i, ymin_i, ymax_i = GdalReader().get_extent(src_i)
-        xmax = max(xmax, xmax_i)
-        xmin = min(xmin, xmin_i)
-        ymax = max(ymax, ymax_i)
-        ymin = min(ymin, ymin_i)
-        bands = max(bands, src_i.RasterCount)
-
-    # Aligne Pixels
-    xmin = math.floor(xmin / xres) * xres
-    xmax = math.ceil(xmax / xres) * xres
-    ymin = math.floor(ymin / -yres) * -yres
-    ymax = math.ceil(ymax / -yres) * -yres
-
-    # Create output if it does not already exist.
-    geotransform = [xmin, xres, 0, ymax, 0, yres]
-    xsize = int(math.ceil((xmax - xmin) / xres))
-    ysize = int(math.ceil((ymin - ymax) / yres))
-
-    # Copy data from source files into output file 1.
-    out_array = np.empty((ysize, xsize))
-    out_array[:] = np.nan
-
-    borders = []
-    for src_i in src_ds_list:
-        for band in xrange(1, src_ds.RasterCount + 1):
+        self.feather = max(1, int(feather))
+        self.seams = np.zeros((ysize, xsize), dtype=bool) if smooth_edges else None
 
-            geotransform_i = src_i.GetGeoTransform()
-            if not int(xres) == int(geotransform_i[1]) or not int(yres) == int(geotransform_i[5]):
-                logging.error('Merge cannot be performed because the layer resolution are different: ' +
-                              str(xres) + ',' + str(yres) + ' vs. ' + str(geotransform_i[1]) + ','
-                              + str(geotransform_i[5]))
+    @classmethod
+    def from_grid(cls, src, outname, extent=None, **kwargs):
+        """ Empty mosaic with the same grid of the source raster
+        :param extent: (xmin, xmax, ymin, ymax). Only the pixels of the grid within the extent are covered.
+        """
 
-                continue
+        src_ds = gdal_import.src2ds(src)
+        geotransform = list(src_ds.GetGeoTransform())
+        xsize = src_ds.RasterXSize
+        ysize = src_ds.RasterYSize
+
+        if extent is not None:
+            # Same window than poly_clip
+            ul_x, ul_y = GdalReader().world2pixel(geotransform, extent[0], extent[3])
+            lr_x, lr_y = GdalReader().world2pixel(geotransform, extent[1], extent[2])
+
+            ul_x, ul_y = max(0, ul_x), max(0, ul_y)
+            lr_x, lr_y = min(xsize, lr_x), min(ysize, lr_y)
+
+            if lr_x > ul_x and lr_y > ul_y:
+                geotransform[0] += geotransform[1] * ul_x + geotransform[2] * ul_y
+                geotransform[3] += geotransform[5] * ul_y + geotransform[4] * ul_x
+                xsize, ysize = lr_x - ul_x, lr_y - ul_y
+
+        return cls(outname, geotransform, src_ds.GetProjection(), xsize, ysize,
+                   nodata=src_ds.GetRasterBand(1).GetNoDataValue(), **kwargs)
+
+    @classmethod
+    def from_extent(cls, src_ds_list, outname, **kwargs):
+        """ Empty mosaic covering the extent of all the sources (only the metadata is read)"""
+
+        src_ds = src_ds_list[0]
+        geotransform = src_ds.GetGeoTransform()
+        xres = geotransform[1]
+        yres = geotransform[5]
+
+        # Get common extent
+        xmin, xmax, ymin, ymax = GdalReader().get_extent(src_ds)
+
+        for src_i in src_ds_list:
 
             xmin_i, xmax_i, ymin_i, ymax_i = GdalReader().get_extent(src_i)
-            xoff = int(math.ceil((xmin_i - xmin) / xres))
-            yoff = int(math.ceil((ymax_i - ymax) / yres))
+            xmax = max(xmax, xmax_i)
+            xmin = min(xmin, xmin_i)
+            ymax = max(ymax, ymax_i)
+            ymin = min(ymin, ymin_i)
+
+        # Aligne Pixels
+        xmin = math.floor(xmin / xres) * xres
+        xmax = math.ceil(xmax / xres) * xres
+        ymin = math.floor(ymin / -yres) * -yres
+        ymax = math.ceil(ymax / -yres) * -yres
+
+        geotransform = [xmin, xres, 0, ymax, 0, yres]
+        xsize = int(math.ceil((xmax - xmin) / xres))
+        ysize = int(math.ceil((ymin - ymax) / yres))
+
+        return cls(outname, geotransform, src_ds.GetProjection(), xsize, ysize,
+                   nodata=src_ds.GetRasterBand(1).GetNoDataValue(), **kwargs)
+
+    def _create(self, array):
+
+        nbands = 1 if array.ndim == 2 else len(array)
+        self.out_ds = GdalReader().create_ds(self.outname, self.xsize, self.ysize, nbands, GdalReader().np2type(array))
+        self.out_ds.SetGeoTransform(self.geotransform)
+        self.out_ds.SetProjection(self.projection)
+
+        if not miscellaneous.is_number(self.nodata):
+            self.nodata = np.nan if array.dtype.kind == 'f' else 0
+
+        for bid in xrange(nbands):
+            band = self.out_ds.GetRasterBand(bid + 1)
+            band.SetNoDataValue(self.nodata)
+            band.Fill(self.nodata)
+
+    def add(self, src):
+        """ Write the tile in its window of the mosaic. The parts of the tile out of the mosaic are discarded."""
+
+        src_ds = gdal_import.src2ds(src)
+        geotransform_i = src_ds.GetGeoTransform()
+
+        xres = self.geotransform[1]
+        yres = self.geotransform[5]
 
-            x_size_i = src_i.RasterXSize
-            y_size_i = src_i.RasterYSize
-            array_i = GdalReader().ds2array(src_i)
+        if not int(xres) == int(geotransform_i[1]) or not int(yres) == int(geotransform_i[5]):
+            logging.error('Merge cannot be performed because the layer resolution are different: ' +
+                          str(xres) + ',' + str(yres) + ' vs. ' + str(geotransform_i[1]) + ','
+                          + str(geotransform_i[5]))
+            return
 
-            out_array[yoff:yoff + y_size_i, xoff:xoff + x_size_i] = array_i
+        # Tile window in the mosaic
+        xoff = int(round((geotransform_i[0] - self.geotransform[0]) / xres))
+        yoff = int(round((geotransform_i[3] - self.geotransform[3]) / yres))
 
-            #slice_i = out_array[yoff:yoff + y_size_i, xoff:xoff + x_size_i]
-            #out_array[yoff:yoff + y_size_i, xoff:xoff + x_size_i] = np.where(
-            #    np.ma.getmask(np.ma.masked_invalid(array_i[band - 1])), slice_i, array_i[band - 1])
+        x_min, y_min = max(0, xoff), max(0, yoff)
+        x_max = min(self.xsize, xoff + src_ds.RasterXSize)
+        y_max = min(self.ysize, yoff + src_ds.RasterYSize)
 
-            # Edges smoothing
-            if smooth_edges:
-                mask = np.where(np.ma.getmask(np.ma.masked_invalid(array_i[band - 1])), np.nan, 1)
+        if x_max <= x_min or y_max <= y_min:
+            logging.debug('Tile out of the mosaic: ' + str(src_ds.GetMetadataItem('FilePath')))
+            return
 
-                if smooth_edges:
-                    borders_i = [([i + yoff, j + xoff]
-                                  if 0 < [mask[i - 1, j], mask[i + 1, j], mask[i, j - 1], mask[i, j + 1]].count(1) < 4
-                                  else None)
-                                 if (1 <= i < mask.shape[0] - 1) and (1 <= j < mask.shape[1] - 1) else None
-                                 # ([i+yoff, j+xoff] if mask[i, j] == 1 else None)
-                                 for i, j in np.ndindex(mask.shape)]
-                    borders = borders + borders_i
+        window = GdalReader().window_tuple(xoff=x_min - xoff, yoff=y_min - yoff, xsize=x_max - x_min,
+                                           ysize=y_max - y_min)
+        array = GdalReader().read_array(src_ds, window=window)
 
-    # Edges smoothing
-    if smooth_edges:
-        for k in borders:
-            if k:
-                out_array[k[0], k[1]] = np.nanmean(out_array[k[0] - 1:k[0] + 1, k[1] - 1:k[1] + 1])
+        if array.dtype.kind == 'f':
+            array = array.astype(numpy_tools.working_dtype(), copy=False)
 
-    return GdalReader().array2ds(src_array=out_array, output=outname, projection=projection, geotransform=geotransform,
-                                 nodata=nodata)
+        if self.out_ds is None:
+            self._create(array)
+
+        GdalReader().write_block(self.out_ds, array, x_min, y_min)
+
+        if self.seams is not None:
+            self.seams[y_min:y_max, x_min:x_max] |= numpy_tools.seam_mask(array, nodata=self.nodata)
+
+    def _blend(self):
+        """ Blend the seams strip by strip. The strips are read with the rows required by the blending and the
+        rows already blended by the previous strip are restored from the original values.
+        """
+
+        pad = self.feather + 1
+        chunk_rows = max(pad, int(Config().get('chunk_shape', (512, 512))[0]))
+
+        original_rows = None
+        for window in GdalReader().block_windows(self.out_ds, chunk_shape=(chunk_rows, self.xsize)):
+
+            y_min = max(0, window.yoff - pad)
+            y_max = min(self.ysize, window.yoff + window.ysize + pad)
+
+            if not self.seams[y_min:y_max].any():
+                # Strip not modified
+                original_rows = None
+                continue
+
+            strip_window = GdalReader().window_tuple(xoff=window.xoff, yoff=y_min, xsize=window.xsize,
+                                                     ysize=y_max - y_min)
+            array = np.array(GdalReader().read_array(self.out_ds, window=strip_window))
+
+            if original_rows is not None:
+                array[..., :original_rows.shape[-2], :] = original_rows
+
+            # Original values of the rows read again by the next strip
+            next_y_min = max(0, window.yoff + window.ysize - pad)
+            original_rows = array[..., next_y_min - y_min:window.yoff + window.ysize - y_min, :].copy()
+
+            blended = numpy_tools.seam_blend(array, self.seams[y_min:y_max, window.xoff:window.xoff + window.xsize],
+                                             width=self.feather, nodata=self.nodata)
+
+            core = blended[..., window.yoff - y_min:window.yoff - y_min + window.ysize, :]
+            GdalReader().write_block(self.out_ds, core, window.xoff, window.yoff)
+
+    def close(self):
+        """ Flush and return the mosaic dataset (None if no tiles were added)"""
+
+        if self.out_ds is None:
+            logging.error('Mosaic cannot be created. No tiles found.')
+            return
+
+        if self.seams is not None:
+            self._blend()
+            self.seams = None
+
+        self.out_ds.FlushCache()
+        return self.out_ds
+
+
+def merge(src_ds_list, outname, smooth_edges=False, feather=1):
+    """ Merge rasters with the same resolution. The output is created up front and each raster is written in its
+    window (see TileMosaic).
+    :param smooth_edges: Boolean. Blend the seams between rasters
+    :param feather: Blending width of the seams in pixels
+    """
+
+    mosaic = TileMosaic.from_extent([GdalReader().gdal2ds(r) for r in src_ds_list], outname,
+                                    smooth_edges=smooth_edges, feather=feather)
+
+    for src_i in src_ds_list:
+        mosaic.add(src_i)
+
+    return mosaic.close()
+
+
+def poly_extent(raster, polygons):
+    """ Extent (xmin, xmax, ymin, ymax) of the polygons clipped to the raster extent, in the raster projection
+    (extent of poly_clip). None if the polygons do not overlap the raster."""
+
+    src_ds = gdal_import.src2ds(raster)
+    poly_reprojected = ogr_utils.reproject(ogr_import.src2ogr(polygons), wtk_projection=src_ds.GetProjection(),
+                                           outname='polygons_reprojected')
+
+    poly_ds = ogr_import.src2ogr(poly_reprojected)
+    poly_lyr = poly_ds.GetLayer()
+
+    r_min_x, r_max_x, r_min_y, r_max_y = GdalReader().get_extent(src_ds)
+
+    wkt = 'POLYGON((' + ','.join([' '.join([str(r_min_x), str(r_max_y)]), ' '.join([str(r_min_x), str(r_min_y)]),
+                                  ' '.join([str(r_max_x), str(r_min_y)]), ' '.join([str(r_max_x), str(r_max_y)]),
+                                  ' '.join([str(r_min_x), str(r_max_y)])]) + '))'
+
+    geom = ogr.CreateGeometryFromWkt(wkt)
+    poly_lyr.SetSpatialFilter(geom)
+
+    extent = None
+    for feature in poly_lyr:
+        intersection_geom = feature.GetGeometryRef().Intersection(geom)
+
+        if intersection_geom is None or intersection_geom.IsEmpty():
+            continue
+
+        xmin, xmax, ymin, ymax = intersection_geom.GetEnvelope()
+
+        if extent is None:
+            extent = [xmin, xmax, ymin, ymax]
+
+        else:
+            extent = [min(extent[0], xmin), max(extent[1], xmax), min(extent[2], ymin), max(extent[3], ymax)]
+
+    poly_lyr.SetSpatialFilter(None)
+
+    return extent
 
 
 def poly_clip(raster, polygons, outuput):
@@ -268,18 +516,16 @@ def poly_clip(raster, polygons, outuput):
     geo_trans[0] = extent[0]
     geo_trans[3] = extent[3]
 
-    # Get the new array to layer extent
-    rarray = gdal_array.DatasetReadAsArray(src_ds)
-
-    if len(rarray.shape) == 3:
-        clip = rarray[:, ul_y:lr_y, ul_x:lr_x]
+    # Get the new array to layer extent (only the window is read)
+    ul_x, ul_y = max(0, ul_x), max(0, ul_y)
+    lr_x, lr_y = min(src_ds.RasterXSize, lr_x), min(src_ds.RasterYSize, lr_y)
 
-    elif len(rarray.shape) == 2:
-        clip = rarray[ul_y:lr_y, ul_x:lr_x]
-
-    else:
+    if not lr_x > ul_x or not lr_y > ul_y:
         return logging.error('Error in array shape.')
 
+    window = GdalReader().window_tuple(xoff=ul_x, yoff=ul_y, xsize=lr_x - ul_x, ysize=lr_y - ul_y)
+    clip = GdalReader().read_array(src_ds, window=window)
+
     new_array = clip_raster_array(vds=filtered_poly_ds, raster_array=clip, geotransform=geo_trans, nodata=nodata)
 
     return GdalReader().array2ds(src_array=np.array(new_array), output=outuput, geotransform=geo_trans,
@@ -358,6 +604,6 @@ def clip_raster_array(vds, raster_array, geotransform, nodata=0):
         mask.shape = rasterpoly.im.size[1], rasterpoly.im.size[0]
 
         # Clip the image using the mask (Note that np.uint8 does not allow nan values
-        new_array.append(np.choose(mask, (raster_array_i, nodata)).astype(np.float))
+        new_array.append(np.choose(mask, (raster_array_i, nodata)).astype(numpy_tools.working_dtype()))
 
     return np.array(new_array)
@@ -10,6 +10,9 @@
 """ This Basic tools for raster spatial analysis """
 
 import logging
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
 
 from spatial import gdal_import
 from spatial import gdal_reader
@@ -17,20 +20,197 @@ from toolbox.raster import gdal_utils
 from spatial.gdal_reader import GdalReader
 
 from toolbox import numpy_tools
+from core import miscellaneous
+from core.bunch import Config
+from spatial import raster_cache
 
 
-def raster_stats(input_raster, output=None):
+def raster_stats(input_raster, output=None, bins=1024, chunk_shape=None, workers=None, bands=None):
+    """ Statistics of the valid values of a raster (max, min, mean, median and binned mode). The histogram is
+    accumulated block by block (see numpy_tools.HistogramStats), so only one block per thread is kept in memory.
+    :param bins: number of histogram bins for the mode and percentiles
+    :param chunk_shape: (rows, cols) of the blocks (Config()['chunk_shape'] by default)
+    :param workers: number of threads (Config()['stats_threads'] or the number of CPUs by default)
+    :param bands: list of band numbers (starting from 1). All bands if not defined.
+    """
 
-    logging.debug('Starting histogram_matching... ')
+    logging.debug('Starting raster_stats... ')
+
+    stats = raster_histogram(input_raster, bins=bins, chunk_shape=chunk_shape, workers=workers, bands=bands)
+
+    if stats is None:
+        return
+
+    return stats.stats()
+
+
+def _stats_key(file_path):
+    """ Key of the statistics sidecar (file fingerprint)"""
+
+    return list(GdalReader.fingerprint(file_path))
+
+
+def _stats_entry(bins, bands=None):
+    """ Name of the statistics in the sidecar (number of bins and bands)"""
+
+    if bands:
+        return 'bins=' + str(int(bins)) + ';bands=' + ','.join(str(int(band)) for band in bands)
+
+    return 'bins=' + str(int(bins))
+
+
+def _is_scratch(file_path):
+    """ Files in the tempdir (created by the process)"""
+
+    tempdir = os.path.abspath(Config()['tempdir'])
+
+    return os.path.abspath(file_path).startswith(os.path.join(tempdir, ''))
+
+
+def save_raster_stats(file_path, stats, bands=None):
+    """ Store the histogram statistics of an output raster file in its sidecar, so they are not computed again
+    (see raster_histogram).
+    """
+
+    if miscellaneous.str2bool(Config().get('stats_sidecar', True)) and os.path.isfile(file_path):
+        raster_cache.save_stats(file_path, _stats_key(file_path), _stats_entry(stats.bins, bands), stats.asdict())
+
+
+def raster_histogram(input_raster, bins=1024, chunk_shape=None, workers=None, bands=None):
+    """ Mergeable histogram statistics of a raster (see numpy_tools.HistogramStats). The blocks are read twice:
+    first for the range of values and then for the histogram. Statistics found in the sidecar of a raster file
+    are reused while the file is not modified (unless Config()['stats_sidecar'] is False). Sidecars are only
+    written for scratch files of the tempdir (outputs are stored with save_raster_stats), so input directories
+    are not modified.
+    """
 
     src_ds = gdal_import.src2ds(input_raster)
-    raster_array = GdalReader().ds2array(src_ds)
-    return numpy_tools.array_stats(raster_array)
+    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+
+    file_path = src_ds.GetDescription()
+    sidecar = miscellaneous.str2bool(Config().get('stats_sidecar', True)) and file_path and os.path.isfile(file_path)
+
+    if sidecar:
+        stats = raster_cache.load_stats(file_path, _stats_key(file_path), _stats_entry(bins, bands))
+
+        if stats:
+            logging.debug('Statistics read from sidecar: ' + str(file_path))
+            return numpy_tools.HistogramStats.from_dict(stats)
+
+    if chunk_shape is None:
+        chunk_shape = Config().get('chunk_shape', (1024, 1024))
+
+    if workers is None:
+        workers = Config().get('stats_threads', multiprocessing.cpu_count())
+
+    read_window, thread_safe = GdalReader().window_reader(src_ds, bands=bands)
+    windows = list(GdalReader().block_windows(src_ds, chunk_shape))
+    workers = max(1, min(int(workers), len(windows))) if thread_safe else 1
+
+    def accumulate(value_range):
+        # Statistics of each block merged in a single accumulator
+        def block_stats(window):
+            return numpy_tools.HistogramStats(value_range, bins=bins).update(read_window(window), nodata=nodata)
+
+        return _merge_blocks(block_stats, windows, numpy_tools.HistogramStats(value_range, bins), workers=workers)
+
+    value_range = accumulate(None)
+
+    if not value_range.count:
+        logging.error('raster_stats aborted. Raster does not have valid values')
+        return
+
+    stats = accumulate((value_range.min, value_range.max))
+
+    if sidecar and _is_scratch(file_path):
+        raster_cache.save_stats(file_path, _stats_key(file_path), _stats_entry(bins, bands), stats.asdict())
+
+    return stats
 
-def single_bands_to_multiband(bands_list, output=None):
+
+def _merge_blocks(block_function, windows, accumulator, workers=1):
+    """ Apply the function to each window and merge the partial results in the accumulator as they are completed
+    (in a pool of threads if workers > 1)
+    """
+
+    if workers > 1:
+        pool = ThreadPool(workers)
+
+        try:
+            for partial in pool.imap_unordered(block_function, windows):
+                accumulator.merge(partial)
+
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        for window in windows:
+            accumulator.merge(block_function(window))
+
+    return accumulator
+
+
+def zonal_accumulator(input_raster, zones, resize=True, chunk_shape=None, workers=None):
+    """ Statistics by zone accumulated block by block (see numpy_tools.ZonalAccumulator). Only one block of values
+    and zones per thread is kept in memory.
+    :param input_raster: raster with the values (first band)
+    :param zones: raster with the zone IDs (first band) in the same grid than the values
+    :param resize: Boolean. Use the common area if the rasters have different size
+    :param chunk_shape: (rows, cols) of the blocks (Config()['chunk_shape'] by default)
+    :param workers: number of threads (Config()['stats_threads'] or the number of CPUs by default)
+    """
+
+    src_ds = gdal_import.src2ds(input_raster)
+    zones_ds = gdal_import.src2ds(zones)
+    nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+
+    windows = zone_windows(src_ds, zones_ds, resize=resize, chunk_shape=chunk_shape)
+    if windows is None:
+        return
+
+    if workers is None:
+        workers = Config().get('stats_threads', multiprocessing.cpu_count())
+
+    read_values, values_thread_safe = GdalReader().window_reader(src_ds, bands=[1])
+    read_zones, zones_thread_safe = GdalReader().window_reader(zones_ds, bands=[1])
+
+    if not values_thread_safe or not zones_thread_safe:
+        workers = 1
+
+    def block_stats(window):
+        return numpy_tools.ZonalAccumulator().update(read_values(window), read_zones(window), nodata=nodata)
+
+    return _merge_blocks(block_stats, windows, numpy_tools.ZonalAccumulator(),
+                         workers=max(1, min(int(workers), len(windows))))
+
+
+def zone_windows(src_ds, zones_ds, resize=True, chunk_shape=None):
+    """ Block windows of the area covered by the values and the zones. None if the sizes do not match and the
+    rasters are not resized.
+    """
+
+    xsize = min(src_ds.RasterXSize, zones_ds.RasterXSize)
+    ysize = min(src_ds.RasterYSize, zones_ds.RasterYSize)
+
+    if not resize and (not src_ds.RasterXSize == zones_ds.RasterXSize or
+                       not src_ds.RasterYSize == zones_ds.RasterYSize):
+        logging.error('Zonal Statistics. Error raster shape does not match')
+        return
+
+    if chunk_shape is None:
+        chunk_shape = Config().get('chunk_shape', (1024, 1024))
+
+    return [GdalReader().window_tuple(xoff=w.xoff, yoff=w.yoff, xsize=min(w.xsize, xsize - w.xoff),
+                                      ysize=min(w.ysize, ysize - w.yoff))
+            for w in GdalReader().block_windows(src_ds, chunk_shape) if w.xoff < xsize and w.yoff < ysize]
+
+
+def single_bands_to_multiband(bands_list, output=None, virtual=False):
 
     gdal_bands_list = [gdal_import.src2ds(i) for i in bands_list]
-    return gdal_import.gdal_import(gdal_utils.single_bands_to_multiband(gdal_bands_list, output=output))
+    return gdal_import.gdal_import(gdal_utils.single_bands_to_multiband(gdal_bands_list, output=output,
+                                                                        virtual=virtual))
 
 
 def poly_clip(raster, polygons, output):
@@ -41,25 +221,57 @@ def poly_clip(raster, polygons, output):
     return gdal_import.gdal_import(gdal_utils.poly_clip(raster, polygons, output))
 
 
-def merge(src_list, outname, smooth_edges=False):
+def merge(src_list, outname, smooth_edges=False, feather=1):
+
+    src_ds_list = [gdal_import.src2ds(r) for r in src_list]
+
+    return gdal_import.gdal_import(gdal_utils.merge(src_ds_list, outname, smooth_edges=smooth_edges,
+                                                    feather=feather))
+
 
-    src_ds_list = [gdal_reader.GdalReader().gdal2ds(r) for r in src_list]
+def mosaic(reference, outname, polygons=None, smooth_edges=False, feather=1):
+    """ Empty mosaic with the grid of the reference raster. Tiles are written with add() as they are completed
+    and the merged raster is returned by close() (see gdal_utils.TileMosaic).
+    :param polygons: the mosaic covers only the extent of the polygons (same extent than poly_clip)
+    """
 
-    return gdal_import.gdal_import(gdal_utils.merge(src_ds_list, outname, smooth_edges=smooth_edges))
+    src_ds = gdal_import.src2ds(reference)
+    extent = gdal_utils.poly_extent(src_ds, polygons) if polygons else None
 
+    return gdal_utils.TileMosaic.from_grid(src_ds, outname, extent=extent, smooth_edges=smooth_edges,
+                                           feather=feather)
 
-def reclassify(input_raster, new_value, old_value_min=None, old_value_max=None, output=None):
+
+def reclassify(input_raster, new_value=None, old_value_min=None, old_value_max=None, output=None, categorical=False,
+               classes=None):
+    """ Reclassify raster values
+    :param categorical: Boolean. Save the classes as uint8 (nodata is 0)
+    :param classes: ordered list of ((min, max), value) rules applied in one pass. The output is uint8 with
+    nodata 0 (see numpy_tools.classify)
+    """
 
     logging.debug('Reclassify raster... ')
 
     src_ds = gdal_import.src2ds(input_raster)
-    raster_array = gdal_reader.GdalReader().ds2array(src_ds)
+    raster_array = gdal_import.src2array(input_raster)
     nodata = src_ds.GetRasterBand(1).GetNoDataValue()
 
-    reclass = numpy_tools.reclassify(raster_array, new_value, old_value_min, old_value_max, nodata=nodata)
+    reclass = numpy_tools.reclassify(raster_array, new_value, old_value_min, old_value_max, nodata=nodata,
+                                     classes=classes)
 
     if not output:
         output = 'reclassified'
 
-    return gdal_import.gdal_import(gdal_reader.GdalReader().array2ds(reclass, output, mask_ds=input_raster))
+    if classes is not None:
+        return gdal_import.gdal_import(gdal_reader.GdalReader().array2ds(
+            reclass, output, geotransform=src_ds.GetGeoTransform(), projection=src_ds.GetProjection(), nodata=0,
+            copy=False))
+
+    if categorical:
+        reclass = numpy_tools.categorical(reclass, nodata=0)
+
+        return gdal_import.gdal_import(gdal_reader.GdalReader().array2ds(
+            reclass, output, geotransform=src_ds.GetGeoTransform(), projection=src_ds.GetProjection(), nodata=0))
+
+    return gdal_import.gdal_import(gdal_reader.GdalReader().array2ds(reclass, output, mask_ds=src_ds))
 